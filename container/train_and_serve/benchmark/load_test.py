@@ -0,0 +1,239 @@
+# Load test of the inference stack (nginx -> gunicorn gevent workers -> predictor.app) on a single
+# Linux box, without SageMaker or Docker.
+#
+# The stack is started with the container's own serve program, against a small model trained on
+# random data (or the model directory given with --model-dir). Every combination of the given batch
+# sizes, concurrencies and content types is then replayed for --duration seconds by closed-loop
+# clients, each sending its next request as soon as the previous one is answered. Throughput and
+# latency percentiles of each scenario are printed and saved as JSON; a previous result given with
+# --baseline flags the scenarios whose throughput or p99 latency regressed.
+#
+# nginx, gunicorn, gevent, flask and catboost must be installed. With --no-nginx, gunicorn is started
+# alone, listening on the port that nginx would use.
+#
+# Example:
+#   python load_test.py --batch-sizes 1,100 --concurrency 1,16 --output results.json
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+program_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'catboost_regressor'))
+model_file_name = 'catboost-regressor-model.dump'
+content_types = ['text/csv', 'application/x-npy']
+
+
+def train_model(model_dir, features, iterations):
+    """Train a small model on random data, so that the benchmark does not depend on a training job."""
+    from catboost import CatBoostRegressor
+
+    rng = np.random.RandomState(0)
+    X = rng.rand(10000, features)
+    y = X @ rng.rand(features) + rng.normal(scale=0.1, size=X.shape[0])
+    model = CatBoostRegressor(iterations=iterations, depth=6, logging_level='Silent', allow_writing_files=False)
+    model.fit(X, y)
+    os.makedirs(model_dir, exist_ok=True)
+    model.save_model(os.path.join(model_dir, model_file_name))
+
+
+def start_stack(model_dir, port, use_nginx, env, log):
+    env = dict(os.environ, MODEL_SERVER_MODEL_DIR=model_dir, MODEL_SERVER_PORT=str(port),
+               MODEL_SERVER_PROGRAM_DIR=program_dir, **env)
+    if use_nginx:
+        command = [sys.executable, os.path.join(program_dir, 'serve')]
+    else:
+        workers = env.get('MODEL_SERVER_WORKERS', str(os.cpu_count()))
+        command = ['gunicorn', '-c', os.path.join(program_dir, 'gunicorn.conf.py'), '-k', 'gevent',
+                   '-b', '127.0.0.1:{}'.format(port), '-w', workers, '--preload', 'wsgi:app']
+    print('Starting {}'.format(' '.join(command)))
+    process = subprocess.Popen(command, cwd=program_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited with status {}'.format(process.returncode))
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/ping')
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.5)
+    stop_stack(process)
+    raise RuntimeError('The server did not answer /ping within 120s')
+
+
+def stop_stack(process):
+    # serve and gunicorn run in their own session, stop all of it
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def request_body(batch_size, features, content_type):
+    data = np.random.RandomState(batch_size).rand(batch_size, features).astype(np.float32)
+    if content_type == 'application/x-npy':
+        out = io.BytesIO()
+        np.save(out, data)
+        return out.getvalue()
+    return ''.join(','.join(repr(value) for value in row) + '\n' for row in data.tolist()).encode()
+
+
+def run_client(port, body, content_type, stop_at, latencies, errors):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': content_type}
+    while time.time() < stop_at:
+        start = time.time()
+        try:
+            connection.request('POST', '/invocations', body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                latencies.append(time.time() - start)
+            else:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.close()
+
+
+def run_scenario(port, batch_size, concurrency, content_type, features, duration, warmup):
+    """Replay one traffic mix and return its statistics."""
+    body = request_body(batch_size, features, content_type)
+    results = []
+    for phase_duration in (warmup, duration):
+        latencies, errors = [], []
+        stop_at = time.time() + phase_duration
+        clients = [threading.Thread(target=run_client, args=(port, body, content_type, stop_at, latencies, errors))
+                   for _ in range(concurrency)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        results.append((latencies, errors, time.time() - start))
+
+    latencies, errors, elapsed = results[-1]
+    latencies = np.array(latencies) * 1000
+    stats = {
+        'batch_size': batch_size, 'concurrency': concurrency, 'content_type': content_type,
+        'requests': int(latencies.size), 'errors': len(errors), 'duration_s': elapsed,
+        'requests_per_s': latencies.size / elapsed, 'rows_per_s': latencies.size * batch_size / elapsed,
+        'request_bytes': len(body),
+    }
+    for q in (50, 95, 99):
+        stats['p{}_ms'.format(q)] = float(np.percentile(latencies, q)) if latencies.size else None
+    if errors:
+        stats['error_types'] = sorted(set(str(error) for error in errors))
+    return stats
+
+
+def describe(stats):
+    latencies = ', '.join('p{} {}'.format(q, 'n/a' if stats['p{}_ms'.format(q)] is None
+                                          else '{:.2f} ms'.format(stats['p{}_ms'.format(q)])) for q in (50, 95, 99))
+    return '{} batch {} x {} clients: {:.1f} req/s, {:.0f} rows/s, {}, {} errors'.format(
+        stats['content_type'], stats['batch_size'], stats['concurrency'], stats['requests_per_s'],
+        stats['rows_per_s'], latencies, stats['errors'])
+
+
+def scenario_key(stats):
+    return stats['batch_size'], stats['concurrency'], stats['content_type']
+
+
+def compare(results, baseline, tolerance):
+    """Return the scenarios whose throughput dropped, or p99 latency grew, by more than tolerance."""
+    previous = dict((scenario_key(stats), stats) for stats in baseline['scenarios'])
+    regressions = []
+    for stats in results['scenarios']:
+        before = previous.get(scenario_key(stats))
+        if before is None:
+            continue
+        if stats['requests_per_s'] < before['requests_per_s'] * (1 - tolerance):
+            regressions.append((stats, 'requests_per_s', before['requests_per_s'], stats['requests_per_s']))
+        if before['p99_ms'] and stats['p99_ms'] and stats['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append((stats, 'p99_ms', before['p99_ms'], stats['p99_ms']))
+    return regressions
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the inference stack locally.')
+    parser.add_argument('--batch-sizes', type=int_list, default=[1, 100, 1000], help='rows per request')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32], help='concurrent clients')
+    parser.add_argument('--content-types', type=lambda value: value.split(','), default=content_types)
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per scenario')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of unmeasured traffic per scenario')
+    parser.add_argument('--features', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=200, help='trees of the generated model')
+    parser.add_argument('--model-dir', type=str, help='serve this model directory instead of a generated model')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--no-nginx', dest='nginx', action='store_false', help='start gunicorn alone')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment of the server, e.g. MODEL_SERVER_BATCHING=true')
+    parser.add_argument('--output', type=str, default='load_test_results.json')
+    parser.add_argument('--server-log', type=str, default='load_test_server.log', help='output of the server')
+    parser.add_argument('--baseline', type=str, help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as a regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server_env = dict(item.split('=', 1) for item in args.env)
+    model_dir = args.model_dir or tempfile.mkdtemp(prefix='load-test-model-')
+    if args.model_dir is None:
+        print('Training a {} trees model on {} random features in {}'.format(args.iterations, args.features, model_dir))
+        train_model(model_dir, args.features, args.iterations)
+
+    log = open(args.server_log, 'w')
+    server = start_stack(model_dir, args.port, args.nginx, server_env, log)
+    scenarios = []
+    try:
+        for content_type in args.content_types:
+            for batch_size in args.batch_sizes:
+                for concurrency in args.concurrency:
+                    stats = run_scenario(args.port, batch_size, concurrency, content_type, args.features,
+                                         args.duration, args.warmup)
+                    print(describe(stats))
+                    scenarios.append(stats)
+    finally:
+        stop_stack(server)
+        log.close()
+        if args.model_dir is None:
+            shutil.rmtree(model_dir, ignore_errors=True)
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'nginx': args.nginx, 'server_env': server_env, 'scenarios': scenarios,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stats, metric, before, after in regressions:
+            print('REGRESSION {content_type} batch {batch_size} x {concurrency}: '.format(**stats) +
+                  '{} {:.2f} -> {:.2f}'.format(metric, before, after))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,366 @@
+# Benchmark of the data pipeline on synthetic datasets shaped like dataset.csv (the label followed
+# by the eight California housing features), from 10^5 rows up to 10^8.
+#
+# For each dataset size, the stages below run in turn, each in its own process, and report their
+# wall time, peak RSS (including the processes they start) and the bytes they wrote:
+#
+#   generate         write the synthetic dataset.csv, in chunks
+#   split            generate_train_validation_files of preprocessing-experiment.py (in memory)
+#   split_sharded    generate_train_validation_files of preprocessing-experiment-multifiles.py
+#                    (split_dataframe and parallel shard writers, in memory)
+#   split_streaming  generate_train_validation_files_streaming of preprocessing-experiment.py
+#   dvc              dvc add of the streamed split in a local Git repository, git commit and push,
+#                    and dvc push to a local directory remote, as done by sync_data_with_dvc
+#   clone            clone_repo of dvc_fetch.py from the bare origin, with --clone-strategy
+#   pull             pull_channels of dvc_fetch.py of the train and validation channels from the
+#                    local remote into the clone, with --dvc-jobs, as done by train
+#   load             load_channel of the pulled train channel, as done by train.py
+#   fit              CatBoostRegressor.fit on the train channel, evaluated on the validation one
+#
+# The in-memory stages are skipped above --max-in-memory-rows and fit above --max-fit-rows. A stage is
+# timed once the modules it uses are imported. A stage whose process dies without reporting (e.g.
+# killed by the OOM killer) or runs longer than --stage-timeout is reported as failed.
+# The results are saved as JSON; a previous result given with --baseline flags the stages whose
+# wall time or peak RSS grew by more than --tolerance.
+#
+# The preprocessing scripts are imported from source_dir, so their dependencies (pandas, scikit-learn,
+# gitpython, sagemaker-experiments) must be installed, as well as dvc, git and catboost.
+#
+# Example:
+#   python pipeline_benchmark.py --rows 100000,1000000 --output-format npy --baseline before.json
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+source_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'source_dir'))
+stages = ['generate', 'split', 'split_sharded', 'split_streaming', 'dvc', 'clone', 'pull', 'load', 'fit']
+in_memory_stages = ['split', 'split_sharded']
+# the preprocessing scripts and modules each stage uses, imported before it is timed
+stage_scripts = {'split': ['preprocessing-experiment'], 'split_sharded': ['preprocessing-experiment-multifiles'],
+                 'split_streaming': ['preprocessing-experiment']}
+stage_modules = {'clone': ['dvc_fetch'], 'pull': ['dvc_fetch'], 'load': ['dataset_loader'],
+                 'fit': ['dataset_loader', 'catboost']}
+# the columns of fetch_california_housing, the label first
+columns = ['MedHouseVal', 'MedInc', 'HouseAge', 'AveRooms', 'AveBedrms', 'Population', 'AveOccup', 'Latitude',
+           'Longitude']
+features = len(columns) - 1
+
+
+def load_script(name):
+    """Import a preprocessing script of source_dir as a module."""
+    sys.path.insert(0, source_dir)
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(source_dir, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    # registered so that the functions it hands to process pools can be pickled
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_dataset(path, rows, chunk_rows=1000000):
+    """Write rows of random data formatted like dataset.csv (np.savetxt of the label and features), with
+    the header row the preprocessing scripts read the column names from."""
+    rng = np.random.RandomState(0)
+    weights = rng.rand(features)
+    with open(path, 'w') as f:
+        for first in range(0, rows, chunk_rows):
+            X = rng.rand(min(chunk_rows, rows - first), features)
+            y = X @ weights + rng.normal(scale=0.1, size=X.shape[0])
+            np.savetxt(f, np.column_stack([y, X]), delimiter=',', header=','.join(columns) if first == 0 else '',
+                       comments='')
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def run_git(*args, cwd):
+    subprocess.check_call(['git'] + list(args), cwd=cwd, stdout=subprocess.DEVNULL)
+
+
+def setup_repository(workspace):
+    """Create a local Git repository with a bare origin, initialized for DVC with a local directory remote."""
+    origin = os.path.join(workspace, 'origin.git')
+    repo = os.path.join(workspace, 'repo')
+    remote = os.path.join(workspace, 'dvc-remote')
+    run_git('init', '--bare', '-q', origin, cwd=workspace)
+    run_git('init', '-q', repo, cwd=workspace)
+    run_git('config', 'user.email', 'benchmark@example.com', cwd=repo)
+    run_git('config', 'user.name', 'benchmark', cwd=repo)
+    run_git('remote', 'add', 'origin', origin, cwd=repo)
+    subprocess.check_call(['dvc', 'init', '-q'], cwd=repo)
+    subprocess.check_call(['dvc', 'remote', 'add', '-d', 'local', remote], cwd=repo)
+    os.makedirs(remote)
+    run_git('add', '-A', cwd=repo)
+    run_git('commit', '-q', '-m', 'init dvc', cwd=repo)
+    return repo
+
+
+class Pipeline(object):
+    """The stages of one dataset size, sharing a workspace directory."""
+
+    def __init__(self, workspace, rows, output_format, chunk_size, iterations, clone_strategy='shallow',
+                 dvc_jobs=None):
+        self.workspace = workspace
+        self.rows = rows
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+        self.iterations = iterations
+        self.input_path = os.path.join(workspace, 'dataset.csv')
+        self.repo = os.path.join(workspace, 'repo')
+        self.clone_path = os.path.join(workspace, 'clone')
+        self.clone_strategy = clone_strategy
+        self.dvc_jobs = dvc_jobs
+        self.ratio = 0.3
+        self.scripts = {}
+
+    def output_dir(self, stage):
+        # the streamed split is written in the Git repository, where the dvc stage tracks it
+        if stage == 'split_streaming':
+            return os.path.join(self.repo, 'dataset')
+        return os.path.join(self.workspace, stage)
+
+    def prepare(self, stage):
+        """Import the scripts and modules stage uses."""
+        for name in stage_scripts.get(stage, []):
+            self.scripts[name] = load_script(name)
+        for name in stage_modules.get(stage, []):
+            importlib.import_module(name)
+
+    def script(self, name, stage):
+        module = self.scripts.get(name) or load_script(name)
+        module.input_data_path = self.input_path
+        module.base_dir = self.output_dir(stage)
+        return module
+
+    def generate(self):
+        generate_dataset(self.input_path, self.rows)
+        setup_repository(self.workspace)
+
+    def split(self):
+        self.script('preprocessing-experiment', 'split').generate_train_validation_files(self.ratio, self.output_format)
+
+    def split_sharded(self):
+        self.script('preprocessing-experiment-multifiles', 'split_sharded').generate_train_validation_files(
+            self.ratio, self.output_format)
+
+    def split_streaming(self):
+        self.script('preprocessing-experiment', 'split_streaming').generate_train_validation_files_streaming(
+            self.ratio, self.chunk_size, 42, self.output_format)
+
+    def dvc(self):
+        targets = ['dataset/{0}/california_{0}.{1}'.format(split, self.output_format)
+                   for split in ('train', 'validation', 'test')]
+        subprocess.check_call(['dvc', 'add', '-q'] + targets, cwd=self.repo)
+        run_git('add', '-A', cwd=self.repo)
+        run_git('commit', '-q', '-m', 'add data', cwd=self.repo)
+        subprocess.check_call(['dvc', 'push', '-q'], cwd=self.repo)
+        run_git('push', '-q', 'origin', 'HEAD', cwd=self.repo)
+
+    def clone(self):
+        from dvc_fetch import clone_repo
+        branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=self.repo).decode().strip()
+        # a file:// URL, as git ignores --depth and --filter when cloning a local path
+        clone_repo('file://' + os.path.join(self.workspace, 'origin.git'), branch, self.clone_path, self.clone_strategy)
+
+    def pull(self):
+        from dvc_fetch import pull_channels
+        pull_channels(os.path.join(self.clone_path, 'dataset'), ['train', 'validation'], jobs=self.dvc_jobs)
+
+    def channel(self, name):
+        from dataset_loader import load_channel
+        return load_channel(os.path.join(self.clone_path, 'dataset', name), name)
+
+    def load(self):
+        self.channel('train')
+
+    def fit(self):
+        from catboost import CatBoostRegressor, Pool
+        X_train, y_train = self.channel('train')
+        X_validation, y_validation = self.channel('validation')
+        model = CatBoostRegressor(iterations=self.iterations, depth=6, allow_writing_files=False)
+        model.fit(Pool(X_train, y_train), eval_set=(X_validation, y_validation), logging_level='Silent')
+
+    def written_paths(self, stage):
+        if stage == 'generate':
+            return [self.input_path, self.repo, os.path.join(self.workspace, 'origin.git')]
+        if stage == 'dvc':
+            return [os.path.join(self.repo, '.dvc', 'cache'), os.path.join(self.workspace, 'dvc-remote'),
+                    os.path.join(self.workspace, 'origin.git')]
+        if stage == 'clone':
+            return [self.clone_path]
+        if stage == 'pull':
+            return [os.path.join(self.clone_path, '.dvc', 'cache'), os.path.join(self.clone_path, 'dataset')]
+        if stage in ('load', 'fit'):
+            return []
+        return [self.output_dir(stage)]
+
+
+def written_bytes(paths):
+    return sum(directory_size(path) if os.path.isdir(path) else os.path.getsize(path)
+               for path in paths if os.path.exists(path))
+
+
+def stage_process(pipeline, stage, results):
+    sys.path.insert(0, source_dir)
+    from phase_metrics import peak_rss, reset_peak_rss
+
+    pipeline.prepare(stage)
+    reset_peak_rss()
+    start = time.time()
+    try:
+        getattr(pipeline, stage)()
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    elapsed = time.time() - start
+    # the peak since the imports on Linux; the children are the shard writers, loader processes and dvc
+    results.put((elapsed, max(peak_rss(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024), error))
+
+
+def wait_for_report(process, results, timeout=None):
+    """Return the report of a stage process, or raise RuntimeError when the process exits without one
+    or is still running after timeout seconds."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            try:
+                # the report may have arrived as the process exited
+                return results.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError('stage process exited with code {} without a report'.format(process.exitcode))
+        if deadline is not None and time.time() > deadline:
+            process.terminate()
+            raise RuntimeError('stage still running after {}s'.format(timeout))
+
+
+def run_stage(pipeline, stage, timeout=None):
+    """Run a stage in a forked process, so that its peak RSS is its own, and return its statistics."""
+    paths = pipeline.written_paths(stage)
+    before = written_bytes(paths)
+    results = multiprocessing.Queue()
+    process = multiprocessing.get_context('fork').Process(target=stage_process, args=(pipeline, stage, results))
+    process.start()
+    try:
+        elapsed, peak_rss, error = wait_for_report(process, results, timeout)
+    except RuntimeError as e:
+        return {'stage': stage, 'rows': pipeline.rows, 'error': str(e)}
+    finally:
+        process.join()
+    stats = {'stage': stage, 'rows': pipeline.rows, 'wall_s': elapsed, 'peak_rss_mb': peak_rss / 1e6,
+             'written_mb': (written_bytes(paths) - before) / 1e6, 'rows_per_s': pipeline.rows / max(elapsed, 1e-9)}
+    if error is not None:
+        stats['error'] = error
+    return stats
+
+
+def describe(stats):
+    if 'skipped' in stats:
+        return '{rows} rows {stage}: skipped ({skipped})'.format(**stats)
+    if 'wall_s' not in stats:
+        return '{rows} rows {stage}: FAILED {error}'.format(**stats)
+    line = '{rows} rows {stage}: {wall_s:.2f}s, {rows_per_s:.0f} rows/s, peak RSS {peak_rss_mb:.0f} MB, ' \
+           'wrote {written_mb:.1f} MB'.format(**stats)
+    return line + (', FAILED {}'.format(stats['error']) if 'error' in stats else '')
+
+
+def compare(results, baseline, tolerance):
+    """Return the stages whose wall time or peak RSS grew by more than tolerance."""
+    previous = dict(((stats['stage'], stats['rows']), stats) for stats in baseline['stages'] if 'wall_s' in stats)
+    regressions = []
+    for stats in results['stages']:
+        before = previous.get((stats['stage'], stats['rows']))
+        if before is None or 'wall_s' not in stats:
+            continue
+        for metric in ('wall_s', 'peak_rss_mb'):
+            if stats[metric] > before[metric] * (1 + tolerance):
+                regressions.append((stats, metric, before[metric], stats[metric]))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing and training stages on synthetic data.')
+    parser.add_argument('--rows', type=lambda value: [int(float(item)) for item in value.split(',')],
+                        default=[100000, 1000000], help='dataset sizes, e.g. 1e5,1e6,1e7')
+    parser.add_argument('--stages', type=lambda value: value.split(','), default=stages)
+    parser.add_argument('--output-format', type=str, default='csv', choices=['csv', 'parquet', 'npy'])
+    parser.add_argument('--chunk-size', type=int, default=100000, help='rows per chunk of the streaming split')
+    parser.add_argument('--iterations', type=int, default=100, help='trees of the fit stage')
+    parser.add_argument('--clone-strategy', type=str, default='shallow', choices=['shallow', 'blobless', 'sparse'])
+    parser.add_argument('--dvc-jobs', type=int, help='parallel downloads of the pull stage')
+    parser.add_argument('--max-in-memory-rows', type=int, default=10 ** 7)
+    parser.add_argument('--max-fit-rows', type=int, default=10 ** 7)
+    parser.add_argument('--stage-timeout', type=float, help='seconds after which a stage is stopped as failed')
+    parser.add_argument('--workdir', type=str, help='directory for the datasets, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='keep the generated datasets')
+    parser.add_argument('--output', type=str, default='pipeline_benchmark_results.json')
+    parser.add_argument('--baseline', type=str, help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative growth reported as a regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pipeline-benchmark-')
+    results = []
+    for rows in args.rows:
+        workspace = os.path.join(workdir, str(rows))
+        shutil.rmtree(workspace, ignore_errors=True)
+        os.makedirs(workspace)
+        pipeline = Pipeline(workspace, rows, args.output_format, args.chunk_size, args.iterations,
+                            args.clone_strategy, args.dvc_jobs)
+        for stage in [stage for stage in stages if stage in args.stages]:
+            if stage in in_memory_stages and rows > args.max_in_memory_rows:
+                stats = {'stage': stage, 'rows': rows, 'skipped': 'above --max-in-memory-rows'}
+            elif stage == 'fit' and rows > args.max_fit_rows:
+                stats = {'stage': stage, 'rows': rows, 'skipped': 'above --max-fit-rows'}
+            else:
+                stats = run_stage(pipeline, stage, args.stage_timeout)
+            print(describe(stats))
+            results.append(stats)
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+    if not args.keep and args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'output_format': args.output_format, 'chunk_size': args.chunk_size, 'iterations': args.iterations,
+        'clone_strategy': args.clone_strategy, 'dvc_jobs': args.dvc_jobs,
+        'stages': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+    failed = [stats for stats in results['stages'] if 'error' in stats]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stats, metric, before, after in regressions:
+            print('REGRESSION {} rows {}: {} {:.2f} -> {:.2f}'.format(stats['rows'], stats['stage'], metric, before, after))
+    sys.exit(1 if failed or regressions else 0)
@@ -0,0 +1,101 @@
+# Coalesces the rows of concurrent requests inside a server worker into a single predict call.
+# It only relies on the threading and queue modules, which gunicorn's gevent worker patches, so
+# the batching thread is a greenlet there and a native thread elsewhere.
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class PendingRequest(object):
+    """The rows of one request waiting for their predictions from a model."""
+
+    def __init__(self, data, model=None):
+        self.data = np.asarray(data, dtype=np.float32)
+        self.model = model
+        self.rows = self.data.shape[0]
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Runs predict_fn(data, model) on batches of at most max_batch_size rows taken from concurrent requests.
+
+    A batch is dispatched as soon as it is full or max_wait_ms after its first request arrived.
+    A single request larger than max_batch_size is predicted on its own."""
+
+    def __init__(self, predict_fn, max_batch_size=1024, max_wait_ms=2):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def predict(self, data, model=None):
+        self.start()
+        request = PendingRequest(data, model)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def start(self):
+        # the queue and thread are created lazily, in the worker after gevent patched threading,
+        # rather than in a master that preloaded the app before forking. The lock then predates
+        # the patching and is a real one, so the thread is started outside of it: Thread.start
+        # yields to the event loop, which would deadlock other greenlets waiting on the lock.
+        thread = None
+        with self.lock:
+            if self.thread is None:
+                self.queue = queue.Queue()
+                self.thread = thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+        if thread is not None:
+            thread.start()
+
+    def run(self):
+        carry = None
+        while True:
+            first = carry if carry is not None else self.queue.get()
+            carry = None
+            batch = [first]
+            rows = first.rows
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if rows + request.rows > self.max_batch_size:
+                    carry = request
+                    break
+                batch.append(request)
+                rows += request.rows
+            self.dispatch(batch)
+
+    def dispatch(self, batch):
+        # requests for different models or with different column counts cannot share a matrix,
+        # predict them separately
+        groups = {}
+        for request in batch:
+            groups.setdefault((id(request.model), request.data.shape[1:]), []).append(request)
+        for requests in groups.values():
+            try:
+                data = requests[0].data if len(requests) == 1 else np.concatenate([r.data for r in requests])
+                predictions = self.predict_fn(data, requests[0].model)
+                offset = 0
+                for request in requests:
+                    request.result = predictions[offset:offset + request.rows]
+                    offset += request.rows
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            for request in requests:
+                request.done.set()
@@ -0,0 +1,177 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# A local cache of parsed dataset channels, keyed by the md5s DVC records for the channel.
+# Jobs that train on the same DVC_BRANCH data memory-map the cached matrices (and optionally
+# a quantized CatBoost Pool) instead of pulling and parsing the shards again.
+import glob
+import hashlib
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from dataset_loader import load_channel
+
+# bump when the parsed representation changes, to invalidate existing entries
+CACHE_VERSION = 1
+
+dvc_md5_pattern = re.compile(r'^\s*-?\s*md5:\s*([0-9a-f]{32}(?:\.dir)?)\s*$', re.MULTILINE)
+
+
+class DatasetCache(object):
+    """A size-capped directory of cache entries, evicted in least recently used order.
+
+    Each entry is a directory named after its key holding features.npy, labels.npy and,
+    when requested, a quantized CatBoost Pool. Files are written under a temporary name
+    and renamed into place, so concurrent jobs sharing the directory never see partial
+    entries."""
+
+    def __init__(self, cache_dir, max_bytes, quantized_pool=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quantized_pool = quantized_pool
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls):
+        """Build the cache configured by DATASET_CACHE_DIR, or return None when it is unset.
+
+        DATASET_CACHE_MAX_GB caps its size (10 GB by default) and DATASET_CACHE_QUANTIZED_POOL
+        set to true also caches the quantized train Pool."""
+        cache_dir = os.environ.get('DATASET_CACHE_DIR')
+        if not cache_dir:
+            return None
+        max_gb = float(os.environ.get('DATASET_CACHE_MAX_GB', 10))
+        quantized_pool = os.environ.get('DATASET_CACHE_QUANTIZED_POOL', 'false').lower() == 'true'
+        return cls(cache_dir, int(max_gb * 1024 ** 3), quantized_pool)
+
+    def channel_key(self, dataset_path, channel_name):
+        """Return the key for a channel from the md5s in its .dvc files, or None if untracked.
+
+        Both layouts written by the preprocessing scripts are supported: a .dvc file per
+        shard inside the channel directory, or a single <channel>.dvc for the directory."""
+        dvc_files = sorted(glob.glob(os.path.join(dataset_path, channel_name, '*.dvc')))
+        channel_dvc_file = os.path.join(dataset_path, channel_name + '.dvc')
+        if os.path.exists(channel_dvc_file):
+            dvc_files.append(channel_dvc_file)
+        md5s = []
+        for dvc_file in dvc_files:
+            with open(dvc_file) as f:
+                md5s.extend(dvc_md5_pattern.findall(f.read()))
+        if len(md5s) == 0:
+            return None
+        digest = hashlib.sha256('{}:{}:{}'.format(CACHE_VERSION, channel_name, ','.join(md5s)).encode())
+        return digest.hexdigest()
+
+    def has_channel(self, dataset_path, channel_name, names=('features.npy', 'labels.npy')):
+        """Return whether the named files of a channel's entry are all cached."""
+        key = self.channel_key(dataset_path, channel_name)
+        return key is not None and all(os.path.exists(self.entry_path(key, name)) for name in names)
+
+    def has_training_data(self, dataset_path, train_channel_name, validation_channel_name):
+        """Return whether training can run from the cache alone, without pulling the shards."""
+        train_names = ('pool.quantized',) if self.quantized_pool else ('features.npy', 'labels.npy')
+        return (self.has_channel(dataset_path, train_channel_name, train_names)
+                and self.has_channel(dataset_path, validation_channel_name))
+
+    def entry_path(self, key, name=None):
+        path = os.path.join(self.cache_dir, key)
+        return path if name is None else os.path.join(path, name)
+
+    def lookup(self, key, names):
+        """Return the paths of the named files of an entry, or None on a miss."""
+        paths = [self.entry_path(key, name) for name in names]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        # the entry directory mtime is the LRU clock
+        os.utime(self.entry_path(key))
+        return paths
+
+    def store(self, key, name, write):
+        """Write one file of an entry with write(path) and evict entries over the size cap."""
+        os.makedirs(self.entry_path(key), exist_ok=True)
+        path = self.entry_path(key, name)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        write(tmp_path)
+        os.rename(tmp_path, path)
+        os.utime(self.entry_path(key))
+        self.evict(keep=key)
+
+    def entry_size(self, key):
+        entry = self.entry_path(key)
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if os.path.isdir(self.entry_path(key)):
+                entries.append((os.path.getmtime(self.entry_path(key)), key, self.entry_size(key)))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print('Dataset cache evict {} ({:.1f} MB)'.format(key, size / 1e6))
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= size
+
+    def load_arrays(self, key):
+        paths = self.lookup(key, ['features.npy', 'labels.npy'])
+        if paths is None:
+            return None
+        return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+    def store_arrays(self, key, features, labels):
+        self.store(key, 'features.npy', lambda path: save_npy(path, features))
+        self.store(key, 'labels.npy', lambda path: save_npy(path, labels))
+
+
+def save_npy(path, array):
+    # np.save appends .npy to file names that do not end with it, so hand it a file object
+    with open(path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+
+
+def load_channel_cached(cache, dataset_path, channel_name, max_workers=None):
+    """Return (features, labels) for a channel, from the cache when its DVC md5s are known."""
+    channel_path = os.path.join(dataset_path, channel_name)
+    key = cache.channel_key(dataset_path, channel_name) if cache is not None else None
+    if key is not None:
+        start = time.time()
+        arrays = cache.load_arrays(key)
+        if arrays is not None:
+            print('Dataset cache hit for {} ({}): {} rows mapped in {:.2f}s'.format(
+                channel_name, key[:12], arrays[0].shape[0], time.time() - start))
+            return arrays
+        print('Dataset cache miss for {} ({})'.format(channel_name, key[:12]))
+    features, labels = load_channel(channel_path, channel_name, max_workers=max_workers)
+    if key is not None:
+        cache.store_arrays(key, features, labels)
+    return features, labels
+
+
+def load_train_pool_cached(cache, dataset_path, channel_name, max_workers=None):
+    """Return a quantized CatBoost Pool for a channel, reusing the cached one when possible.
+
+    The pool is quantized with CatBoost's default settings, so it must only be used with
+    models that do not override the quantization parameters (border_count etc.)."""
+    from catboost import Pool
+
+    key = cache.channel_key(dataset_path, channel_name) if cache is not None else None
+    if key is not None:
+        paths = cache.lookup(key, ['pool.quantized'])
+        if paths is not None:
+            print('Dataset cache hit for quantized {} pool ({})'.format(channel_name, key[:12]))
+            return Pool('quantized://' + paths[0])
+        print('Dataset cache miss for quantized {} pool ({})'.format(channel_name, key[:12]))
+    features, labels = load_channel_cached(cache, dataset_path, channel_name, max_workers=max_workers)
+    pool = Pool(features, labels)
+    pool.quantize()
+    if key is not None:
+        cache.store(key, 'pool.quantized', pool.save)
+    return pool
@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Loads every shard of a dataset channel (e.g. dataset/train) into a single feature matrix
+# and label vector. Shards are written by the preprocessing scripts with the label in the
+# first column, either as headerless CSV, Parquet or float32 .npy files.
+import glob
+import json
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+shard_extensions = ['.npy', '.parquet', '.csv']
+
+
+def list_channel_files(channel_path, channel_name):
+    """Return the sorted list of shard files in channel_path, failing if there are none.
+
+    When a channel holds shards in several formats, the binary ones are preferred."""
+    files = []
+    for extension in shard_extensions:
+        files = sorted(glob.glob(os.path.join(channel_path, "*" + extension)))
+        if len(files) > 0:
+            break
+    if len(files) == 0:
+        raise ValueError(('There are no files in {}.\n' +
+                          'This usually indicates that the channel ({}) was incorrectly specified,\n' +
+                          'the data specification in S3 was incorrectly specified or the role specified\n' +
+                          'does not have permission to access the data.').format(channel_path, channel_name))
+    return files
+
+
+def read_schema(path):
+    """Return the schema sidecar written next to an .npy shard, or None if it is missing."""
+    schema_path = os.path.splitext(path)[0] + '.schema.json'
+    if not os.path.exists(schema_path):
+        return None
+    with open(schema_path) as schema_file:
+        return json.load(schema_file)
+
+
+def read_shard(path):
+    """Return a single shard as a float32 matrix.
+
+    .npy shards are memory-mapped rather than read, Parquet shards are decoded column by
+    column and CSV shards are parsed as headerless text."""
+    if path.endswith('.npy'):
+        matrix = np.load(path, mmap_mode='r')
+        schema = read_schema(path)
+        if schema is not None and (matrix.dtype != np.dtype(schema['dtype'])
+                                   or matrix.shape != (schema['rows'], len(schema['columns']))):
+            raise ValueError('Shard {} does not match its schema {}'.format(path, schema))
+        return matrix if matrix.dtype == np.float32 else matrix.astype(np.float32)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path).to_numpy(dtype=np.float32)
+    return pd.read_csv(path, header=None, dtype=np.float32).values
+
+
+def load_channel(channel_path, channel_name, max_workers=None, use_processes=False):
+    """Read every shard of a channel concurrently and return (features, labels).
+
+    Shards are read in a thread pool (or a process pool when use_processes is set) and
+    copied once into a preallocated matrix, in file name order. A channel made of a single
+    .npy shard is returned as a memory-mapped view without any copy."""
+    files = list_channel_files(channel_path, channel_name)
+    print('Found {} files: {}'.format(channel_name, files))
+
+    start = time.time()
+    if len(files) == 1:
+        data = read_shard(files[0])
+        rows = data.shape[0]
+    else:
+        executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor(max_workers=max_workers) as pool:
+            shards = list(pool.map(read_shard, files))
+
+        widths = set(shard.shape[1] for shard in shards)
+        if len(widths) != 1:
+            raise ValueError('Shards in {} have different column counts: {}'.format(channel_path, sorted(widths)))
+        rows = sum(shard.shape[0] for shard in shards)
+        data = np.empty((rows, widths.pop()), dtype=np.float32)
+        offset = 0
+        for index, shard in enumerate(shards):
+            data[offset:offset + shard.shape[0]] = shard
+            offset += shard.shape[0]
+            shards[index] = None
+
+    elapsed = max(time.time() - start, 1e-9)
+    size = sum(os.path.getsize(file) for file in files)
+    print('Loaded {} rows ({:.1f} MB) from {} files in {:.2f}s: {:.0f} rows/s, {:.1f} MB/s'.format(
+        rows, size / 1e6, len(files), elapsed, rows / elapsed, size / 1e6 / elapsed))
+
+    return data[:, 1:], data[:, 0]
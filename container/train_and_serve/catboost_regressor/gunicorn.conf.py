@@ -0,0 +1,36 @@
+# Gunicorn server hooks, loaded by serve. They log how long the server took to start and the
+# memory of each worker, to check how much of the preloaded model the workers share, and clean up
+# the Prometheus metrics of exited workers.
+
+import os
+import time
+
+
+def memory_usage():
+    """Return the RSS and PSS of this process in MB; PSS splits shared pages between processes."""
+    usage = {}
+    path = '/proc/self/smaps_rollup' if os.path.exists('/proc/self/smaps_rollup') else '/proc/self/status'
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'VmRSS') and value.strip().endswith('kB'):
+                usage[key.replace('VmRSS', 'Rss')] = int(value.split()[0]) / 1024.0
+    return usage
+
+
+def format_memory_usage():
+    return ', '.join('{} {:.1f} MB'.format(key, value) for key, value in sorted(memory_usage().items()))
+
+
+def when_ready(server):
+    started = float(os.environ.get('MODEL_SERVER_START_TIME', time.time()))
+    server.log.info('Server ready in %.2fs, master memory: %s', time.time() - started, format_memory_usage())
+
+
+def post_worker_init(worker):
+    worker.log.info('Worker %s ready, memory: %s', worker.pid, format_memory_usage())
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,58 @@
+# Runs the CPU-bound parts of a request (body parsing and predict) on native threads, so that the
+# event loop of a gevent worker keeps serving /ping and other requests in the meantime.
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected because the executor queue is full."""
+
+
+class InferenceExecutor(object):
+    """A bounded pool of native threads with admission control.
+
+    At most threads + max_queue requests are admitted at a time; admit() raises Overloaded
+    beyond that. Under a gevent worker the work runs on gevent's native thread pool and the
+    calling greenlet yields while it waits; otherwise a regular thread pool is used."""
+
+    def __init__(self, threads=1, max_queue=32):
+        self.threads = threads
+        self.max_admitted = threads + max_queue
+        self.admitted = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        self.native = False
+
+    def get_pool(self):
+        # the pool is created lazily so that its threads belong to the worker, not a pre-fork master
+        if self.pool is None:
+            try:
+                from gevent import monkey
+                from gevent.threadpool import ThreadPool
+                self.native = monkey.is_module_patched('threading')
+            except ImportError:
+                self.native = False
+            self.pool = ThreadPool(self.threads) if self.native else ThreadPoolExecutor(self.threads)
+        return self.pool
+
+    @contextmanager
+    def admit(self):
+        with self.lock:
+            if self.admitted >= self.max_admitted:
+                raise Overloaded('{} requests already admitted'.format(self.admitted))
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.admitted -= 1
+
+    def call(self, fn, *args):
+        """Run fn(*args) on a pool thread and return its result, blocking only the caller."""
+        pool = self.get_pool()
+        if self.native:
+            return pool.spawn(fn, *args).get()
+        return pool.submit(fn, *args).result()
@@ -0,0 +1,106 @@
+# Prometheus metrics of the inference server, served on /metrics by predictor.py.
+#
+# gunicorn runs several worker processes, so the metrics use prometheus_client's multiprocess mode:
+# serve points PROMETHEUS_MULTIPROC_DIR at an empty directory where every worker writes its values,
+# and a scrape of any worker sums them across all of them. Without that variable (e.g. when running
+# a single process) the metrics of the scraped process are returned. When prometheus_client is not
+# installed, metrics are not recorded and /metrics is not available.
+
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:
+    prometheus_client = None
+
+multiprocess_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# seconds, from a tenth of a millisecond to a minute
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+ROWS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000, 1000000)
+
+
+class NullMetric(object):
+    """Stands for every metric when prometheus_client is not installed."""
+
+    def labels(self, *labels):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+if prometheus_client is not None:
+    stage_seconds = Histogram('model_server_stage_seconds', 'Time spent in each stage of an invocation',
+                              ['stage'], buckets=LATENCY_BUCKETS)
+    request_seconds = Histogram('model_server_request_seconds', 'Time spent handling an invocation',
+                                buckets=LATENCY_BUCKETS)
+    request_rows = Histogram('model_server_request_rows', 'Rows per invocation', buckets=ROWS_BUCKETS)
+    predict_rows = Histogram('model_server_predict_rows', 'Rows per CatBoost predict call, after micro-batching',
+                             buckets=ROWS_BUCKETS)
+    requests_total = Counter('model_server_requests_total', 'Invocations by HTTP status', ['status'])
+    model_load_seconds = Histogram('model_server_model_load_seconds', 'Time spent loading a model file',
+                                   buckets=LATENCY_BUCKETS)
+    prediction_cache_rows = Counter('model_server_prediction_cache_rows_total',
+                                    'Rows looked up in the prediction cache', ['result'])
+    prediction_cache_removed_rows = Counter('model_server_prediction_cache_removed_rows_total',
+                                            'Rows removed from the prediction cache, as least recently used or '
+                                            'after their model changed', ['reason'])
+    prediction_cache_size = Gauge('model_server_prediction_cache_size_rows', 'Rows held by the prediction caches',
+                                  multiprocess_mode='livesum')
+    in_flight = Gauge('model_server_in_flight_requests', 'Invocations being handled', multiprocess_mode='livesum')
+else:
+    stage_seconds = request_seconds = request_rows = predict_rows = requests_total = NullMetric()
+    model_load_seconds = prediction_cache_rows = prediction_cache_removed_rows = prediction_cache_size = NullMetric()
+    in_flight = NullMetric()
+
+
+@contextmanager
+def timed(stage):
+    """Record the time spent in the block as a stage of the current invocation."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(stage).observe(time.time() - start)
+
+
+@contextmanager
+def track_request():
+    """Count an invocation in flight while the block runs and record its duration."""
+    start = time.time()
+    in_flight.inc()
+    try:
+        yield
+    finally:
+        in_flight.dec()
+        request_seconds.observe(time.time() - start)
+
+
+def generate():
+    """Return the body and content type of a scrape."""
+    if multiprocess_dir:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited worker, called by gunicorn's child_exit hook."""
+    if prometheus_client is not None and multiprocess_dir:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,187 @@
+# Serves several versions of the model from one container. Each version is a sub-directory of the
+# model directory holding a model file (and optionally the metadata written by train); a model file
+# at the top of the directory is the default version. Loaded models are kept in an LRU cache capped
+# by a memory budget, and a version whose file changed on disk is reloaded in the background while
+# the previous copy keeps serving.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class UnknownModel(Exception):
+    """Raised when a request selects a model version that is not in the model directory."""
+
+
+class ModelVersion(object):
+    """A model file on disk, and the model loaded from it once it is in the cache."""
+
+    def __init__(self, name, path, metadata):
+        self.name = name
+        self.path = path
+        self.metadata = metadata
+        self.mtime = os.path.getmtime(path)
+        self.size = os.path.getsize(path)
+        self.model = None
+        self.loaded_mtime = None
+        self.failed_mtime = None
+
+    def aliases(self):
+        """Names a request may use for this version: its own, and the DVC commit and branch of its data."""
+        names = [self.name]
+        for key in ('dvc_commit', 'dvc_branch'):
+            if self.metadata.get(key):
+                names.append(self.metadata[key])
+        return names
+
+
+class ModelRegistry(object):
+    """Resolves a version name to a loaded model.
+
+    load_fn(path) returns a model loaded from a file. Models are evicted in least recently used
+    order once the files of the loaded ones add up to more than max_bytes (0 disables the cap);
+    the model just requested is never evicted. The directory is scanned again at most every
+    poll_seconds, to pick up new versions and files replaced in place."""
+
+    def __init__(self, model_dir, model_file_name, load_fn, default_version='default', max_bytes=0,
+                 poll_seconds=10, metadata_file_name='model-metadata.json'):
+        self.model_dir = model_dir
+        self.model_file_name = model_file_name
+        self.metadata_file_name = metadata_file_name
+        self.load_fn = load_fn
+        self.default_version = default_version
+        self.max_bytes = max_bytes
+        self.poll_seconds = poll_seconds
+        self.versions = {}
+        self.aliases = {}
+        self.loaded = OrderedDict()
+        self.loading = {}
+        self.scanned = None
+        # never held while a model loads: under gevent a lock created before patching is a native one
+        self.lock = threading.Lock()
+
+    def read_metadata(self, directory):
+        path = os.path.join(directory, self.metadata_file_name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def scan(self):
+        """Index the model files in the model directory, keeping the models already loaded."""
+        found = {}
+        if os.path.exists(os.path.join(self.model_dir, self.model_file_name)):
+            found[self.default_version] = self.model_dir
+        for name in sorted(os.listdir(self.model_dir)) if os.path.isdir(self.model_dir) else []:
+            directory = os.path.join(self.model_dir, name)
+            if name not in found and os.path.exists(os.path.join(directory, self.model_file_name)):
+                found[name] = directory
+
+        versions = {}
+        for name, directory in found.items():
+            version = ModelVersion(name, os.path.join(directory, self.model_file_name), self.read_metadata(directory))
+            current = self.versions.get(name)
+            if current is not None:
+                current.metadata, current.mtime, current.size = version.metadata, version.mtime, version.size
+                version = current
+            versions[name] = version
+        aliases = {}
+        # exact version names win over the DVC commit and branch of another version
+        for version in versions.values():
+            for alias in version.aliases()[1:]:
+                aliases.setdefault(alias, version.name)
+        aliases.update((name, name) for name in versions)
+
+        with self.lock:
+            self.versions, self.aliases = versions, aliases
+            for name in [name for name in self.loaded if name not in versions]:
+                print('Model version {} was removed from {}'.format(name, self.model_dir))
+                self.loaded.pop(name).model = None
+            self.scanned = time.monotonic()
+
+    def resolve(self, name=None):
+        """Return the ModelVersion a version name, DVC commit or DVC branch refers to."""
+        if self.scanned is None or time.monotonic() - self.scanned > self.poll_seconds:
+            self.scan()
+        name = name or self.default_version
+        version = self.versions.get(self.aliases.get(name, name))
+        if version is None and len(name) >= 7:
+            # abbreviated DVC commit hashes; version names and branches only match exactly
+            matches = set(candidate.name for candidate in self.versions.values()
+                          if (candidate.metadata.get('dvc_commit') or '').startswith(name))
+            if len(matches) == 1:
+                version = self.versions[matches.pop()]
+        if version is None:
+            raise UnknownModel('No model version {} in {}, available: {}'.format(
+                name, self.model_dir, ', '.join(sorted(self.versions))))
+        return version
+
+    def get(self, name=None, load_fn=None):
+        """Return the model of a version, loading it on the first request.
+
+        A version whose file changed since it was loaded keeps serving the loaded model while
+        the new file is loaded in the background, then the new model replaces it atomically.
+        load_fn overrides the registry's for a model loaded by this call."""
+        version = self.resolve(name)
+        with self.lock:
+            model = version.model
+            if model is not None:
+                self.loaded.move_to_end(version.name)
+            stale = (model is not None and version.mtime not in (version.loaded_mtime, version.failed_mtime)
+                     and version.name not in self.loading)
+            if stale:
+                self.loading[version.name] = threading.Event()
+        if stale:
+            threading.Thread(target=self.load, args=(version, True), name='model-reload', daemon=True).start()
+        if model is not None:
+            return model
+
+        with self.lock:
+            pending = self.loading.get(version.name)
+            owner = pending is None
+            if owner:
+                pending = self.loading[version.name] = threading.Event()
+        if owner:
+            self.load(version, load_fn=load_fn)
+        else:
+            pending.wait()
+        model = version.model
+        if model is None:
+            raise RuntimeError('Model version {} could not be loaded from {}'.format(version.name, version.path))
+        return model
+
+    def load(self, version, background=False, load_fn=None):
+        try:
+            start = time.time()
+            mtime = version.mtime
+            model = (load_fn or self.load_fn)(version.path)
+            print('Loaded model version {} from {} ({:.1f} MB) in {:.3f}s'.format(
+                version.name, version.path, version.size / 1e6, time.time() - start))
+            with self.lock:
+                version.model, version.loaded_mtime = model, mtime
+                self.loaded[version.name] = version
+                self.loaded.move_to_end(version.name)
+                self.evict(keep=version.name)
+        except Exception as e:
+            print('Failed to load model version {} from {}: {}'.format(version.name, version.path, e))
+            version.failed_mtime = mtime
+            if not background:
+                raise
+        finally:
+            with self.lock:
+                self.loading.pop(version.name).set()
+
+    def evict(self, keep):
+        # called with the lock held
+        total = sum(version.size for version in self.loaded.values())
+        for name in list(self.loaded):
+            if self.max_bytes <= 0 or total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            version = self.loaded.pop(name)
+            print('Evicting model version {} ({:.1f} MB)'.format(name, version.size / 1e6))
+            version.model = None
+            total -= version.size
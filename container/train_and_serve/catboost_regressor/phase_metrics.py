@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Wall time, CPU time, peak RSS and bytes of the phases of a job (git clone, dvc pull, loading, fit, ...).
+# Every phase prints a line that the metric_definitions of an estimator can parse, e.g.
+#   {'Name': 'fit-seconds', 'Regex': 'phase fit: wall_seconds=([0-9.]+)'}
+# and the phases of the job are saved as a JSON report, and can be logged as parameters of its trial
+# component with the SageMaker Experiments Tracker.
+import json
+import os
+import resource
+import time
+
+from contextlib import contextmanager
+
+
+def reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) of the process to its current RSS when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak RSS of this process in bytes, since the last reset_peak_rss on Linux."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_peak_rss():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def cpu_seconds():
+    # user and system time of this process and of the subprocesses it waited for (git, dvc)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class PhaseRecorder(object):
+    """Records the phases of a job, which may be nested (e.g. clone and dvc pull within a fetch)."""
+
+    def __init__(self):
+        self.phases = []
+        self._open = []
+
+    @contextmanager
+    def phase(self, name):
+        """Record the block as the phase name, yielding its record, where the block can set 'bytes'."""
+        record = {'phase': name}
+        if self._open:
+            # keep the peak of the enclosing phase so far, before resetting it
+            self.record_nested_peak(peak_rss())
+        self._open.append(record)
+        reset_peak_rss()
+        children_peak = children_peak_rss()
+        start, start_cpu = time.time(), cpu_seconds()
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['wall_seconds'] = time.time() - start
+            record['cpu_seconds'] = cpu_seconds() - start_cpu
+            # the peak was reset by every nested phase, which recorded it before, and the peak of
+            # the subprocesses only counts when one of this phase set a new maximum
+            peak = max(peak_rss(), record.pop('_nested_peak', 0))
+            if children_peak_rss() > children_peak:
+                peak = max(peak, children_peak_rss())
+            record['peak_rss_mb'] = peak / 1e6
+            self._open.pop()
+            if self._open:
+                self.record_nested_peak(peak)
+            self.phases.append(record)
+            print(self.describe(record))
+
+    def record_nested_peak(self, peak):
+        parent = self._open[-1]
+        parent['_nested_peak'] = max(parent.get('_nested_peak', 0), peak)
+
+    @staticmethod
+    def describe(record):
+        line = 'phase {phase}: wall_seconds={wall_seconds:.3f} cpu_seconds={cpu_seconds:.3f} ' \
+               'peak_rss_mb={peak_rss_mb:.1f}'.format(**record)
+        if record.get('bytes') is not None:
+            line += ' bytes={}'.format(record['bytes'])
+        if record.get('failed'):
+            line += ' failed'
+        return line
+
+    def save(self, path):
+        """Write the phases recorded so far as a JSON report."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'phases': self.phases}, f, indent=2)
+        print('Phase report saved to {}'.format(path))
+
+    def log_to_tracker(self):
+        """Log the phases as parameters of the trial component of the job, e.g. fit_wall_seconds."""
+        try:
+            from smexperiments.tracker import Tracker
+        except ImportError:
+            print('sagemaker-experiments is not installed, phases not logged to the trial component')
+            return
+        parameters = {}
+        for record in self.phases:
+            for key, value in record.items():
+                if key != 'phase':
+                    parameters['{}_{}'.format(record['phase'], key)] = value
+        with Tracker.load() as tracker:
+            tracker.log_parameters(parameters)
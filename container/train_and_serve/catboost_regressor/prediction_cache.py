@@ -0,0 +1,85 @@
+# Remembers the predictions of recently scored feature rows within a server worker, so that rows
+# requested again are answered without going through CatBoost. Rows are keyed by a 64-bit hash of
+# their float32 values and the model version that scored them.
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+HASH_SEED = np.uint64(0x9E3779B97F4A7C15)
+HASH_PRIME = np.uint64(0x100000001B3)
+
+
+def hash_rows(data):
+    """Return a 64-bit hash of the float32 bytes of each row of a 2-D array, computed column by column."""
+    words = np.ascontiguousarray(data, dtype=np.float32).view(np.uint32)
+    hashes = np.full(words.shape[0], HASH_SEED, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for column in range(words.shape[1]):
+            hashes ^= words[:, column].astype(np.uint64)
+            hashes *= HASH_PRIME
+            hashes ^= hashes >> np.uint64(29)
+    return hashes
+
+
+class PredictionCache(object):
+    """An LRU mapping of (model version, row hash) to a prediction, holding at most max_rows rows.
+
+    The entries of a version are dropped as soon as it is served by a different model object,
+    e.g. after its file was replaced and reloaded."""
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.models = {}
+        # rows evicted and invalidated since the last removed_since_last_call; hits and misses are
+        # counted by the caller, in the metrics of metrics.py
+        self.evicted = 0
+        self.invalidated = 0
+        self.lock = threading.Lock()
+
+    def check_model(self, version, model):
+        # called with the lock held
+        current = self.models.get(version)
+        if current is not None and current() is model:
+            return
+        if current is not None:
+            stale = [key for key in self.entries if key[0] == version]
+            for key in stale:
+                del self.entries[key]
+            self.invalidated += len(stale)
+        self.models[version] = weakref.ref(model)
+
+    def lookup(self, version, model, hashes):
+        """Return (predictions, found) for the given row hashes; predictions is undefined where found is False."""
+        predictions = np.empty(len(hashes), dtype=np.float64)
+        found = np.zeros(len(hashes), dtype=bool)
+        with self.lock:
+            self.check_model(version, model)
+            for index, row_hash in enumerate(hashes.tolist()):
+                prediction = self.entries.get((version, row_hash))
+                if prediction is not None:
+                    self.entries.move_to_end((version, row_hash))
+                    predictions[index] = prediction
+                    found[index] = True
+        return predictions, found
+
+    def store(self, version, model, hashes, predictions):
+        with self.lock:
+            self.check_model(version, model)
+            for row_hash, prediction in zip(hashes.tolist(), np.asarray(predictions).tolist()):
+                self.entries[(version, row_hash)] = prediction
+                self.entries.move_to_end((version, row_hash))
+            overflow = len(self.entries) - self.max_rows
+            for _ in range(max(overflow, 0)):
+                self.entries.popitem(last=False)
+            self.evicted += max(overflow, 0)
+
+    def removed_since_last_call(self):
+        """Return the rows evicted and invalidated since the previous call, and the rows held."""
+        with self.lock:
+            evicted, invalidated = self.evicted, self.invalidated
+            self.evicted = self.invalidated = 0
+            return evicted, invalidated, len(self.entries)
@@ -8,39 +8,320 @@ import json
 import pickle
 import sys
 import signal
+import time
 import traceback
 import flask
+import itertools
+import numpy as np
 import pandas as pd
 from catboost import CatBoostRegressor
-from io import StringIO
+from io import BytesIO
+
+import metrics
+from batching import MicroBatcher
+from contextlib import ExitStack, contextmanager
+from inference_executor import InferenceExecutor, Overloaded
+from model_registry import ModelRegistry, UnknownModel
+from prediction_cache import PredictionCache, hash_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 
 prefix = '/opt/ml/'
-model_path = os.path.join(prefix, 'model')
+model_path = os.environ.get('MODEL_SERVER_MODEL_DIR', os.path.join(prefix, 'model'))
+model_file_name = 'catboost-regressor-model.dump'
+
+# Model versions, see model_registry.py. A request selects one with the X-Model-Version header or a
+# model-version=<name> SageMaker custom attribute; the name may also be the DVC commit or branch of
+# the version's training data. Requests without either use the default version.
+default_model_version = os.environ.get('MODEL_SERVER_DEFAULT_MODEL_VERSION', 'default')
+model_cache_mb = float(os.environ.get('MODEL_SERVER_MODEL_CACHE_MB', 0))
+model_poll_seconds = float(os.environ.get('MODEL_SERVER_MODEL_POLL_SECONDS', 10))
+MODEL_VERSION_HEADER = 'X-Model-Version'
+CUSTOM_ATTRIBUTES_HEADER = 'X-Amzn-SageMaker-Custom-Attributes'
+
+CSV_CONTENT_TYPE = 'text/csv'
+NPY_CONTENT_TYPE = 'application/x-npy'
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_CONTENT_TYPE = 'application/x-parquet'
+JSONLINES_CONTENT_TYPE = 'application/jsonlines'
+
+# Micro-batching of concurrent requests within a worker, see batching.py
+batching_enabled = os.environ.get('MODEL_SERVER_BATCHING', 'false').lower() == 'true'
+max_batch_size = int(os.environ.get('MODEL_SERVER_MAX_BATCH_SIZE', 1024))
+max_batch_wait_ms = float(os.environ.get('MODEL_SERVER_MAX_BATCH_WAIT_MS', 2))
+
+# Native threads running parsing and inference per worker (0 runs them on the event loop), and
+# how many more requests may wait for them before new ones are rejected with a 503
+inference_threads = int(os.environ.get('MODEL_SERVER_INFERENCE_THREADS', 1))
+inference_max_queue = int(os.environ.get('MODEL_SERVER_INFERENCE_MAX_QUEUE', 32))
+# CatBoost threads per prediction, chosen by serve together with the number of workers (-1 uses every core)
+predict_threads = int(os.environ.get('MODEL_SERVER_PREDICT_THREADS', -1))
+
+# Rows whose predictions are remembered per worker, see prediction_cache.py (0 disables the cache)
+prediction_cache_rows = int(os.environ.get('MODEL_SERVER_PREDICTION_CACHE_ROWS', 0))
+
+# Streaming of CSV requests: the body is read, predicted and answered in chunks of about
+# MODEL_SERVER_STREAM_CHUNK_MB, so that memory is bounded by the chunk size instead of the payload size
+streaming_enabled = os.environ.get('MODEL_SERVER_STREAMING', 'false').lower() == 'true'
+stream_chunk_bytes = int(float(os.environ.get('MODEL_SERVER_STREAM_CHUNK_MB', 4)) * 1024 ** 2)
 
-# A singleton for holding the model. This simply loads the model and holds it.
-# It has a predict function that does a prediction based on the model and the input data.
+def load_model(path):
+    start = time.time()
+    model = CatBoostRegressor()
+    model.load_model(path)
+    metrics.model_load_seconds.observe(time.time() - start)
+    return model
+
+# A singleton for holding the models. This simply loads the models and holds them.
+# It has a predict function that does a prediction based on a model and the input data.
 
 class ScoringService(object):
-    model = None                # Where we keep the model when it's loaded
+    registry = None             # Where we keep the models when they're loaded
+
+    @classmethod
+    def get_registry(cls):
+        if cls.registry == None:
+            # models requested by a worker are loaded on the executor threads, like predictions
+            cls.registry = ModelRegistry(model_path, model_file_name, lambda path: offload(load_model, path),
+                                         default_model_version, int(model_cache_mb * 1024 ** 2), model_poll_seconds)
+        return cls.registry
 
     @classmethod
-    def get_model(cls):
-        """Get the model object for this instance, loading it if it's not already loaded."""
-        if cls.model == None:
-            cls.model = CatBoostRegressor()
-            cls.model.load_model(os.path.join(model_path, 'catboost-regressor-model.dump'))
-        return cls.model
+    def get_model(cls, version=None):
+        """Get the model object of a version (the default one if None), loading it if it's not already loaded."""
+        return cls.get_registry().get(version)
 
     @classmethod
-    def predict(cls, input):
+    def warm_up(cls):
+        """Load the model and run a dummy prediction, so the first requests do not pay for it."""
+        start = time.time()
+        try:
+            # loaded on the calling thread: the executor threads must not be started in a preloading master
+            model = cls.get_registry().get(load_fn=load_model)
+        except UnknownModel as e:
+            print('Skipping the warm-up: {}'.format(e))
+            return
+        loaded = time.time()
+        # a single thread keeps CatBoost from starting a thread pool that a fork would not inherit
+        model.predict(np.zeros((1, len(model.feature_names_)), dtype=np.float32), thread_count=1)
+        print('Model loaded in {:.3f}s and warmed up in {:.3f}s'.format(loaded - start, time.time() - loaded))
+
+    @classmethod
+    def predict(cls, input, model=None):
         """For the input, do the predictions and return them.
 
         Args:
             input (a pandas dataframe): The data on which to do the predictions. There will be
-                one prediction per row in the dataframe"""
-        clf = cls.get_model()
-        return clf.predict(input)
+                one prediction per row in the dataframe
+            model: The model to use, the default version if None"""
+        clf = model if model is not None else cls.get_model()
+        metrics.predict_rows.observe(input.shape[0])
+        return clf.predict(input, thread_count=predict_threads)
+
+executor = InferenceExecutor(inference_threads, inference_max_queue) if inference_threads > 0 else None
+
+@contextmanager
+def admit():
+    """Admit a request to the executor, raising Overloaded when its queue is full."""
+    if executor is None:
+        yield
+    else:
+        with executor.admit():
+            yield
+
+def offload(fn, *args):
+    """Run CPU-bound work on the executor threads so the worker's event loop stays responsive."""
+    if executor is None:
+        return fn(*args)
+    return executor.call(fn, *args)
+
+def predict_offloaded(data, model=None):
+    return offload(ScoringService.predict, data, model)
+
+batcher = MicroBatcher(predict_offloaded, max_batch_size, max_batch_wait_ms) if batching_enabled else None
+
+prediction_cache = PredictionCache(prediction_cache_rows) if prediction_cache_rows > 0 else None
+
+def predict_rows(data, model):
+    # together with the rows of concurrent requests when batching is enabled
+    if batcher is not None:
+        return batcher.predict(data, model)
+    return predict_offloaded(data, model)
+
+def predict_cached(data, model, version):
+    """Predict the rows of data that are not in the prediction cache, and take the others from it."""
+    if prediction_cache is None or not isinstance(data, np.ndarray) or data.ndim != 2:
+        return predict_rows(data, model)
+    hashes = offload(hash_rows, data)
+    predictions, found = prediction_cache.lookup(version, model, hashes)
+    hits = int(found.sum())
+    metrics.prediction_cache_rows.labels('hit').inc(hits)
+    metrics.prediction_cache_rows.labels('miss').inc(len(found) - hits)
+    if not found.all():
+        missing = ~found
+        predictions[missing] = predict_rows(data if not found.any() else data[missing], model)
+        prediction_cache.store(version, model, hashes[missing], predictions[missing])
+    evicted, invalidated, rows = prediction_cache.removed_since_last_call()
+    metrics.prediction_cache_removed_rows.labels('evicted').inc(evicted)
+    metrics.prediction_cache_removed_rows.labels('invalidated').inc(invalidated)
+    metrics.prediction_cache_size.set(rows)
+    return predictions
+
+# Request decoders and response encoders for each supported content type. Binary payloads are
+# decoded straight into float32 arrays, without going through text or a pandas DataFrame.
+
+# Text is parsed and formatted in blocks of lines: a single C call over a whole large payload
+# would hold the GIL for its full duration and stall the worker's event loop.
+CSV_BLOCK_ROWS = 65536
+# parse_numeric_csv beats pandas' C parser on small bodies only, where the fixed cost of read_csv
+# dominates; from about 500 rows of 8 features up pandas is faster, up to 3 times on large batches.
+CSV_FAST_PATH_MAX_BYTES = 32 * 1024
+
+def parse_numeric_csv(body):
+    """Parse a purely numeric CSV body into a float32 matrix without building a DataFrame.
+
+    Raises ValueError unless every line holds the same number of numeric values."""
+    body = body.replace(b'\r', b'').strip()
+    if len(body) == 0:
+        raise ValueError('empty body')
+    raw = np.frombuffer(body, dtype=np.uint8)
+    commas = np.cumsum(raw == ord(','))
+    line_ends = np.append(np.flatnonzero(raw == ord('\n')), raw.size)
+    commas_per_line = np.diff(np.concatenate(([0], commas[line_ends - 1])))
+    if (commas_per_line != commas_per_line[0]).any():
+        raise ValueError('lines have different numbers of values')
+    rows, columns = line_ends.size, int(commas_per_line[0]) + 1
+    values = np.empty((rows, columns), dtype=np.float32)
+    for first in range(0, rows, CSV_BLOCK_ROWS):
+        last = min(first + CSV_BLOCK_ROWS, rows)
+        start = 0 if first == 0 else line_ends[first - 1] + 1
+        block = np.fromstring(body[start:line_ends[last - 1]].replace(b'\n', b','), dtype=np.float32, sep=',')
+        if block.size != (last - first) * columns:
+            raise ValueError('body is not a numeric CSV')
+        values[first:last] = block.reshape(-1, columns)
+    return values
+
+def decode_csv(body):
+    if len(body) <= CSV_FAST_PATH_MAX_BYTES:
+        try:
+            return parse_numeric_csv(body)
+        except ValueError:
+            # quoted fields, missing values and other irregular input go through pandas
+            pass
+    return pd.read_csv(BytesIO(body), header=None, dtype=np.float32).to_numpy()
+
+def decode_npy(body):
+    """Wrap the array in an .npy payload without copying it out of the request body."""
+    header = BytesIO(body)
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    if dtype.hasobject:
+        raise ValueError('object arrays are not supported')
+    count = int(np.prod(shape)) if len(shape) > 0 else 1
+    array = np.frombuffer(body, dtype=dtype, count=count, offset=header.tell())
+    array = array.reshape(shape[::-1]).T if fortran_order else array.reshape(shape)
+    if array.ndim == 1:
+        array = array.reshape(1, -1)
+    return array if array.dtype == np.float32 else array.astype(np.float32)
+
+def table_to_array(table):
+    """Copy the columns of an Arrow table into a single column-major float32 matrix."""
+    array = np.empty((table.num_rows, table.num_columns), dtype=np.float32, order='F')
+    for index, column in enumerate(table.columns):
+        array[:, index] = column.to_numpy()
+    return array
+
+def decode_arrow(body):
+    return table_to_array(pa.ipc.open_stream(pa.py_buffer(body)).read_all())
+
+def decode_parquet(body):
+    return table_to_array(pq.read_table(pa.BufferReader(body)))
+
+def encode_csv(predictions):
+    """One prediction per line, formatted like pandas' to_csv but without building a DataFrame."""
+    values = np.asarray(predictions).ravel()
+    return b''.join(
+        ('\n'.join(map(repr, values[first:first + CSV_BLOCK_ROWS].tolist())) + '\n').encode('ascii')
+        for first in range(0, values.size, CSV_BLOCK_ROWS)
+    )
+
+def encode_jsonlines(predictions):
+    """One JSON object per line, holding the prediction of the matching input row."""
+    values = np.asarray(predictions).ravel()
+    return b''.join(
+        ''.join('{{"prediction": {!r}}}\n'.format(value) for value in values[first:first + CSV_BLOCK_ROWS].tolist())
+        .encode('ascii')
+        for first in range(0, values.size, CSV_BLOCK_ROWS)
+    )
+
+def encode_npy(predictions):
+    out = BytesIO()
+    np.save(out, np.ascontiguousarray(predictions), allow_pickle=False)
+    return out.getvalue()
+
+def results_table(predictions):
+    return pa.Table.from_arrays([pa.array(predictions)], names=['results'])
+
+def encode_arrow(predictions):
+    out = pa.BufferOutputStream()
+    table = results_table(predictions)
+    with pa.ipc.new_stream(out, table.schema) as writer:
+        writer.write_table(table)
+    return out.getvalue().to_pybytes()
+
+def encode_parquet(predictions):
+    out = pa.BufferOutputStream()
+    pq.write_table(results_table(predictions), out)
+    return out.getvalue().to_pybytes()
+
+decoders = {CSV_CONTENT_TYPE: decode_csv, NPY_CONTENT_TYPE: decode_npy}
+encoders = {CSV_CONTENT_TYPE: encode_csv, NPY_CONTENT_TYPE: encode_npy, JSONLINES_CONTENT_TYPE: encode_jsonlines}
+if pa is not None:
+    decoders.update({ARROW_CONTENT_TYPE: decode_arrow, PARQUET_CONTENT_TYPE: decode_parquet})
+    encoders.update({ARROW_CONTENT_TYPE: encode_arrow, PARQUET_CONTENT_TYPE: encode_parquet})
+
+# CSV stays the response type unless the client asks for another one through Accept
+response_content_types = [CSV_CONTENT_TYPE] + [content_type for content_type in encoders if content_type != CSV_CONTENT_TYPE]
+
+# Line-oriented response types, which can be written chunk by chunk
+streamed_content_types = [CSV_CONTENT_TYPE, JSONLINES_CONTENT_TYPE]
+
+def read_row_chunks(stream, chunk_bytes):
+    """Yield the body of a CSV request in chunks of whole lines, reading about chunk_bytes at a time."""
+    carry = b''
+    while True:
+        block = stream.read(chunk_bytes)
+        if not block:
+            break
+        block = carry + block
+        end = block.rfind(b'\n')
+        if end < 0:
+            carry = block
+            continue
+        carry = block[end + 1:]
+        yield block[:end + 1]
+    if carry.strip():
+        yield carry
+
+def requested_model_version(request):
+    """Return the model version selected by a request, or None for the default one."""
+    version = request.headers.get(MODEL_VERSION_HEADER)
+    if version:
+        return version.strip()
+    # SageMaker only forwards custom attributes to the container, e.g. model-version=<name>
+    for attribute in request.headers.get(CUSTOM_ATTRIBUTES_HEADER, '').split(','):
+        key, _, value = attribute.partition('=')
+        if key.strip() == 'model-version' and value.strip():
+            return value.strip()
+    return None
 
 # The flask app for serving predictions
 app = flask.Flask(__name__)
@@ -49,35 +330,157 @@ app = flask.Flask(__name__)
 def ping():
     """Determine if the container is working and healthy. In this sample container, we declare
     it healthy if we can load the model successfully."""
-    health = ScoringService.get_model() is not None  # You can insert a health check here
+    try:
+        health = ScoringService.get_model() is not None  # You can insert a health check here
+    except UnknownModel:
+        health = False
 
     status = 200 if health else 404
     return flask.Response(response='\n', status=status, mimetype='application/json')
 
+@app.route('/metrics', methods=['GET'])
+def scrape_metrics():
+    """Prometheus metrics of the invocations, summed over all the workers, see metrics.py."""
+    if metrics.prometheus_client is None:
+        return flask.Response(response='prometheus_client is not installed', status=404, mimetype='text/plain')
+    body, content_type = metrics.generate()
+    return flask.Response(response=body, status=200, content_type=content_type)
+
 @app.route('/invocations', methods=['POST'])
 def transformation():
-    """Do an inference on a single batch of data. In this sample server, we take data as CSV, convert
-    it to a pandas data frame for internal use and then convert the predictions back to CSV (which really
-    just means one prediction per line, since there's a single column.
+    """Do an inference on a single batch of data. In this sample server, we take data as CSV, NPY,
+    Arrow stream or Parquet, convert it to a pandas data frame or float32 array for internal use and
+    then convert the predictions back to CSV (which really just means one prediction per line, since
+    there's a single column), or to the binary type requested through the Accept header.
     """
+    tracked = ExitStack()
+    tracked.enter_context(metrics.track_request())
+    try:
+        response = invoke()
+    except BaseException:
+        tracked.close()
+        metrics.requests_total.labels('500').inc()
+        raise
+    if response.is_streamed:
+        # the rest of a streamed body is predicted while it is sent: the request stays in flight until
+        # the response is closed, and invoke_streaming counts its final status
+        response.call_on_close(tracked.close)
+    else:
+        tracked.close()
+        metrics.requests_total.labels(str(response.status_code)).inc()
+    return response
+
+def invoke():
     data = None
 
-    # Convert from CSV to pandas
-    if flask.request.content_type == 'text/csv':
-        data = flask.request.data.decode('utf-8')
-        s = StringIO(data)
-        data = pd.read_csv(s, header=None)
-    else:
-        return flask.Response(response='This predictor only supports CSV data', status=415, mimetype='text/plain')
+    decoder = decoders.get(flask.request.mimetype)
+    if decoder is None:
+        return flask.Response(response='This predictor only supports {} data'.format(', '.join(decoders)),
+                              status=415, mimetype='text/plain')
+    accept = flask.request.accept_mimetypes.best_match(response_content_types, default=CSV_CONTENT_TYPE)
+    try:
+        version = ScoringService.get_registry().resolve(requested_model_version(flask.request))
+    except UnknownModel as e:
+        return flask.Response(response=str(e), status=404, mimetype='text/plain')
+    if streaming_enabled and flask.request.mimetype == CSV_CONTENT_TYPE and accept in streamed_content_types:
+        return invoke_streaming(version, accept)
+
+    try:
+        with admit():
+            with metrics.timed('model'):
+                model = ScoringService.get_model(version.name)
+
+            with metrics.timed('read'):
+                body = flask.request.get_data()
+            try:
+                with metrics.timed('decode'):
+                    data = offload(decoder, body)
+            except ValueError as e:
+                return flask.Response(response='Could not decode {} data: {}'.format(flask.request.mimetype, e),
+                                      status=400, mimetype='text/plain')
+
+            print('Invoked with {} records on model version {}'.format(data.shape[0], version.name))
+            metrics.request_rows.observe(data.shape[0])
+
+            # Do the prediction, reusing the cached predictions of rows seen before when the cache is enabled
+            with metrics.timed('predict'):
+                predictions = predict_cached(data, model, version.name)
+
+            # Convert from numpy back to the response type
+            with metrics.timed('encode'):
+                result = offload(encoders[accept], predictions)
+    except Overloaded:
+        return flask.Response(response='The predictor is overloaded, retry later', status=503,
+                              mimetype='text/plain')
+
+    return flask.Response(response=result, status=200, mimetype=accept, headers={MODEL_VERSION_HEADER: version.name})
+
+def invoke_streaming(version, accept):
+    """Predict a CSV request chunk by chunk of rows, streaming the response back as each chunk is done.
+
+    The first chunk is predicted before the response starts, so that it can still be rejected
+    with an HTTP error; a later chunk that fails aborts the response instead."""
+
+    def predict_chunk(data):
+        with metrics.timed('predict'):
+            predictions = predict_cached(data, model, version.name)
+        with metrics.timed('encode'):
+            return data.shape[0], offload(encoders[accept], predictions)
+
+    def decoded_chunks(chunks):
+        while True:
+            with metrics.timed('read'):
+                body = next(chunks, None)
+            if body is None:
+                return
+            with metrics.timed('decode'):
+                data = offload(decode_csv, body)
+            yield data
 
-    print('Invoked with {} records'.format(data.shape[0]))
+    admission = ExitStack()
+    try:
+        admission.enter_context(admit())
+    except Overloaded:
+        return flask.Response(response='The predictor is overloaded, retry later', status=503,
+                              mimetype='text/plain')
+    try:
+        with metrics.timed('model'):
+            model = ScoringService.get_model(version.name)
+        chunks = read_row_chunks(flask.request.stream, stream_chunk_bytes)
+        with metrics.timed('read'):
+            body = next(chunks, b'')
+        try:
+            with metrics.timed('decode'):
+                data = offload(decode_csv, body)
+        except ValueError as e:
+            admission.close()
+            return flask.Response(response='Could not decode {} data: {}'.format(CSV_CONTENT_TYPE, e),
+                                  status=400, mimetype='text/plain')
+        first = predict_chunk(data)
+    except Exception:
+        admission.close()
+        raise
 
-    # Do the prediction
-    predictions = ScoringService.predict(data)
+    # nginx's status for a client that closed the connection, until the whole body is sent
+    status = 499
 
-    # Convert from numpy back to CSV
-    out = StringIO()
-    pd.DataFrame({'results':predictions}).to_csv(out, header=False, index=False)
-    result = out.getvalue()
+    def generate():
+        nonlocal status
+        total = 0
+        try:
+            for rows, result in itertools.chain([first], map(predict_chunk, decoded_chunks(chunks))):
+                total += rows
+                yield result
+        except Exception:
+            status = 500
+            raise
+        status = 200
+        metrics.request_rows.observe(total)
+        print('Streamed {} records on model version {}'.format(total, version.name))
 
-    return flask.Response(response=result, status=200, mimetype='text/csv')
+    response = flask.Response(flask.stream_with_context(generate()), status=200, mimetype=accept,
+                              headers={MODEL_VERSION_HEADER: version.name})
+    # the admission is released once the response is sent, or the client went away
+    response.call_on_close(admission.close)
+    response.call_on_close(lambda: metrics.requests_total.labels(str(status)).inc())
+    return response
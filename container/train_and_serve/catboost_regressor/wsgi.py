@@ -5,3 +5,7 @@ import predictor as myapp
 # new file.
 
 app = myapp.app
+
+# Load the model when the app is imported: once in the gunicorn master when serve preloads the app,
+# so that the workers share its memory copy-on-write, or at the start of each worker otherwise.
+myapp.ScoringService.warm_up()
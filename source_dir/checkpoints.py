@@ -0,0 +1,55 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# CatBoost snapshots of the training progress in the SageMaker checkpoint directory. SageMaker only
+# creates /opt/ml/checkpoints when the job has a checkpoint S3 URI, syncs it to S3 while training and
+# restores it when a managed spot job is restarted after an interruption, so that a restarted fit
+# resumes from the last snapshot instead of from the first iteration.
+import hashlib
+import json
+import os
+
+checkpoint_dir = '/opt/ml/checkpoints'
+
+# parameters that do not change the trained model, and may differ after a restart on another instance
+RUNTIME_PARAMS = ('thread_count', 'train_dir', 'allow_writing_files', 'logging_level')
+
+
+def snapshot_path(model, directory=checkpoint_dir):
+    """Return the snapshot path of the parameters of model in directory, or None when it does not exist.
+
+    The snapshots of other parameters are kept apart: CatBoost resumes a snapshot of, e.g.,
+    another learning rate without complaining."""
+    if not directory or not os.path.isdir(directory):
+        return None
+    params = dict((name, value) for name, value in model.get_params().items() if name not in RUNTIME_PARAMS)
+    key = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    # CatBoost resolves a relative snapshot file against its train_dir
+    return os.path.join(os.path.abspath(directory), 'catboost-{}.snapshot'.format(key))
+
+
+def fit_with_snapshot(model, train_pool, eval_set=None, snapshot_dir=checkpoint_dir, snapshot_interval=600,
+                      **fit_params):
+    """Fit model, saving a snapshot in snapshot_dir every snapshot_interval seconds and resuming from it.
+
+    A snapshot of other data (e.g. of another DVC commit in the same checkpoint location) cannot be
+    resumed; it is discarded and the model is trained from scratch."""
+    from catboost import CatBoostError
+
+    snapshot_file = snapshot_path(model, snapshot_dir)
+    if snapshot_file is None:
+        return model.fit(train_pool, eval_set=eval_set, **fit_params)
+    if os.path.exists(snapshot_file):
+        print('resuming the training from snapshot {}'.format(snapshot_file))
+    fit_params.update(save_snapshot=True, snapshot_file=snapshot_file, snapshot_interval=snapshot_interval)
+    try:
+        return model.fit(train_pool, eval_set=eval_set, **fit_params)
+    except CatBoostError as e:
+        if "Can't load progress from snapshot" not in str(e):
+            raise
+        print('discarding snapshot {} of another training: {}'.format(snapshot_file, e))
+        try:
+            os.remove(snapshot_file)
+        except OSError:
+            pass
+        return model.fit(train_pool, eval_set=eval_set, **fit_params)
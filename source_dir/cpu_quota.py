@@ -0,0 +1,29 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The CPUs a job or the model server may use. In a container, os.cpu_count() is the host's core count,
+# while the container only gets the share set by its CPU affinity and cgroup CPU quota.
+import math
+import os
+
+
+def available_cpus():
+    """The CPUs this container may use: its CPU affinity, capped by a cgroup (v2 or v1) CPU quota."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quota = period = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            fields = f.read().split()
+        if fields[0] != 'max':
+            quota, period = int(fields[0]), int(fields[1])
+    except (OSError, IndexError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+        except (OSError, ValueError):
+            pass
+    if quota is not None and quota > 0 and period:
+        cpus = min(cpus, max(int(math.ceil(quota / period)), 1))
+    return cpus
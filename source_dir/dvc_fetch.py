@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Clones the DVC Git repository and fetches only the DVC-tracked channels a job consumes,
+# instead of a bare `dvc pull` of the whole dataset directory.
+import glob
+import os
+import subprocess
+import time
+
+
+clone_strategies = ['shallow', 'blobless', 'sparse']
+
+
+def clone_repo(repo_url, branch, path, strategy='shallow', sparse_paths=('dataset', '.dvc')):
+    """Check out the tip of branch into path, reusing a working copy already there.
+
+    All strategies fetch a single commit. blobless additionally defers downloading file
+    contents until checkout, and sparse only checks out sparse_paths (plus top-level files)."""
+    if strategy not in clone_strategies:
+        raise ValueError('Unknown clone strategy {}, expected one of {}'.format(strategy, clone_strategies))
+    if os.path.isdir(os.path.join(path, '.git')):
+        print('Reusing working copy in {}, fetching {}'.format(path, branch))
+        subprocess.check_call(['git', 'fetch', '--depth', '1', 'origin', branch], cwd=path)
+        subprocess.check_call(['git', 'checkout', '--force', '-B', branch, 'FETCH_HEAD'], cwd=path)
+        # keep the DVC cache in .dvc/cache, but drop outputs of the previous run
+        subprocess.check_call(['git', 'clean', '-ffdx', '--', 'dataset'], cwd=path)
+        return
+
+    command = ['git', 'clone', '--depth', '1', '--branch', branch]
+    if strategy in ('blobless', 'sparse'):
+        command.append('--filter=blob:none')
+    if strategy == 'sparse':
+        command.append('--sparse')
+    print('Running {}'.format(' '.join(command + [repo_url, path])))
+    subprocess.check_call(command + [repo_url, path])
+    if strategy == 'sparse':
+        subprocess.check_call(['git', 'sparse-checkout', 'set'] + list(sparse_paths), cwd=path)
+
+
+def channel_targets(dataset_dir, channel_names):
+    """Return the .dvc files tracking the given channels.
+
+    Both layouts written by the preprocessing scripts are supported: a .dvc file per shard
+    inside the channel directory, or a single <channel>.dvc for the directory."""
+    targets = []
+    for channel_name in channel_names:
+        channel_dvc_file = os.path.join(dataset_dir, channel_name + '.dvc')
+        if os.path.exists(channel_dvc_file):
+            targets.append(channel_dvc_file)
+        targets.extend(sorted(glob.glob(os.path.join(dataset_dir, channel_name, '**', '*.dvc'), recursive=True)))
+    if len(targets) == 0:
+        raise ValueError('No .dvc files found for channels {} in {}'.format(channel_names, dataset_dir))
+    return targets
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def pull_channels(dataset_dir, channel_names, jobs=None, cache_dir=None):
+    """Check out the given channels from the DVC cache, pulling them only when needed.
+
+    cache_dir points the repository at a DVC cache shared across jobs. When that cache
+    already holds every object of the channels, `dvc checkout` restores them without
+    contacting the remote; otherwise `dvc pull` downloads the missing objects with the
+    given number of parallel jobs. Returns the number of bytes downloaded."""
+    if cache_dir:
+        subprocess.check_call(['dvc', 'cache', 'dir', '--local', cache_dir], cwd=dataset_dir)
+    targets = [os.path.relpath(target, dataset_dir) for target in channel_targets(dataset_dir, channel_names)]
+    print('DVC targets for channels {}: {}'.format(channel_names, targets))
+
+    start = time.time()
+    try:
+        subprocess.check_call(['dvc', 'checkout', '--quiet'] + targets, cwd=dataset_dir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print('DVC cache holds all objects, skipped pull ({:.2f}s)'.format(time.time() - start))
+        return 0
+    except subprocess.CalledProcessError:
+        pass
+
+    dvc_cache_dir = subprocess.check_output(['dvc', 'cache', 'dir'], cwd=dataset_dir).decode().strip()
+    cache_size = directory_size(dvc_cache_dir)
+    command = ['dvc', 'pull']
+    if jobs:
+        command += ['--jobs', str(jobs)]
+    print('Running {}'.format(' '.join(command + targets)))
+    subprocess.check_call(command + targets, cwd=dataset_dir)
+    elapsed = max(time.time() - start, 1e-9)
+    transferred = directory_size(dvc_cache_dir) - cache_size
+    print('dvc pull fetched {:.1f} MB in {:.2f}s ({:.1f} MB/s)'.format(
+        transferred / 1e6, elapsed, transferred / 1e6 / elapsed))
+    return transferred
@@ -0,0 +1,161 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Trains several CatBoostRegressor configurations in one job, concurrently and on the same
+# quantized train Pool, instead of launching a job (and a clone, dvc pull and parse of the same
+# data) per configuration. The CPUs are split between the configurations trained at a time.
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from checkpoints import fit_with_snapshot
+from cpu_quota import available_cpus
+
+
+def parse_search_space(value):
+    """Return a search space given as a JSON object, or as the path of a JSON file.
+
+    Each key is a CatBoostRegressor parameter and its value either a list of candidates, a
+    {"min": ..., "max": ...} range (with "log": true to sample it on a log scale) or a single
+    value. A range of integers is sampled as integers."""
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def sample_value(rng, domain):
+    if isinstance(domain, list):
+        return rng.choice(domain)
+    if not isinstance(domain, dict):
+        return domain
+    low, high = domain['min'], domain['max']
+    if domain.get('log'):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    if isinstance(low, int) and isinstance(high, int):
+        return int(round(value))
+    return value
+
+
+def configurations(space, samples=None, seed=0, max_draws_per_sample=100):
+    """Return the grid of the candidates of every parameter, or samples distinct random configurations.
+
+    Ranges can only be sampled, so a space holding one requires samples. A space of lists is sampled
+    from its grid without replacement, and a space with ranges is drawn from until samples distinct
+    configurations are found (or max_draws_per_sample draws per sample have been made), so that no
+    configuration is trained twice. Fewer configurations are returned when the space has fewer."""
+    names = sorted(space)
+    ranges = any(isinstance(space[name], dict) for name in names)
+    if not samples and ranges:
+        raise ValueError('A search space with ranges needs a number of samples')
+    rng = random.Random(seed)
+    if not ranges:
+        candidates = [space[name] if isinstance(space[name], list) else [space[name]] for name in names]
+        # a candidate listed twice would otherwise give the same configuration twice
+        grid = list(dict((json.dumps(config, sort_keys=True), config) for config in
+                         (dict(zip(names, values)) for values in itertools.product(*candidates))).values())
+        if not samples:
+            return grid
+        configs = rng.sample(grid, min(samples, len(grid)))
+    else:
+        configs, seen = [], set()
+        for _ in range(samples * max_draws_per_sample):
+            config = dict((name, sample_value(rng, space[name])) for name in names)
+            key = json.dumps(config, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                configs.append(config)
+                if len(configs) == samples:
+                    break
+    if len(configs) < samples:
+        print('The search space only holds {} distinct configurations of the {} samples'.format(
+            len(configs), samples))
+    return configs
+
+
+def run_sweep(train_pool, X_validation, y_validation, configs, parallelism=None, base_params=None,
+              early_stopping_rounds=None, snapshot_dir=None, snapshot_interval=600):
+    """Train every configuration on train_pool and return (results, best model).
+
+    parallelism configurations are trained at a time (by default as many as there are CPUs available
+    to the container, up to the number of configurations), each with an equal share of them as CatBoost
+    threads. Each result holds the parameters and validation metrics of a configuration, and
+    the best model is the one with the lowest validation RMSE. When snapshot_dir exists, each
+    configuration is snapshotted there (see checkpoints.py) so that a restarted sweep resumes."""
+    from catboost import CatBoostRegressor
+
+    cpus = available_cpus()
+    parallelism = max(min(parallelism or cpus, len(configs)), 1)
+    thread_count = max(cpus // parallelism, 1)
+    if not train_pool.is_quantized():
+        start = time.time()
+        train_pool.quantize()
+        print('Quantized the train pool in {:.2f}s'.format(time.time() - start))
+    print('Training {} configurations, {} at a time with {} threads each'.format(len(configs), parallelism,
+                                                                               thread_count))
+
+    def fit(index, params):
+        result = {'configuration': index, 'params': params}
+        start = time.time()
+        try:
+            # each fit writes its own catboost_info directory, which snapshots need, or none at all
+            if not snapshot_dir or not os.path.isdir(snapshot_dir):
+                model_params = dict(allow_writing_files=False)
+            else:
+                model_params = dict(train_dir=os.path.join(tempfile.gettempdir(), 'catboost_info-{}'.format(index)))
+            model_params['thread_count'] = thread_count
+            model_params.update(base_params or {})
+            model_params.update(params)
+            model = CatBoostRegressor(**model_params)
+            fit_with_snapshot(model, train_pool, (X_validation, y_validation), snapshot_dir, snapshot_interval,
+                              early_stopping_rounds=early_stopping_rounds, logging_level='Silent')
+        except Exception as e:
+            result['error'] = str(e)
+            print('Configuration {} {} failed: {}'.format(index, params, e))
+            return result, None
+        abs_err = np.abs(model.predict(X_validation) - y_validation)
+        result.update({
+            'validation_rmse': model.get_best_score()['validation']['RMSE'],
+            'best_iteration': model.get_best_iteration(),
+            'fit_seconds': time.time() - start,
+        })
+        for q in [10, 50, 90]:
+            result['ae_p{}'.format(q)] = float(np.percentile(a=abs_err, q=q))
+        print('Configuration {} {}: validation RMSE {:.6f} in {:.1f}s'.format(
+            index, params, result['validation_rmse'], result['fit_seconds']))
+        return result, model
+
+    results, best_model, best_rmse = [], None, None
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        for result, model in pool.map(fit, range(len(configs)), configs):
+            results.append(result)
+            if model is not None and (best_rmse is None or result['validation_rmse'] < best_rmse):
+                best_model, best_rmse = model, result['validation_rmse']
+    if best_model is None:
+        raise RuntimeError('Every configuration of the sweep failed')
+    return results, best_model
+
+
+def write_results(results, path):
+    """Write one row per configuration, with a column per parameter and metric."""
+    param_names = sorted(set(name for result in results for name in result['params']))
+    metric_names = ['validation_rmse', 'best_iteration', 'ae_p10', 'ae_p50', 'ae_p90', 'fit_seconds', 'error']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['configuration'] + param_names + metric_names)
+        for result in sorted(results, key=lambda result: result.get('validation_rmse', float('inf'))):
+            writer.writerow([result['configuration']] + [result['params'].get(name) for name in param_names]
+                            + [result.get(name) for name in metric_names])
+    print('Sweep results saved to {}'.format(path))
@@ -2,9 +2,19 @@
 # SPDX-License-Identifier: MIT-0
 import os
 import argparse
+import configparser
+import hashlib
+import json
+import math
+import re
+import resource
+import struct
 import sys
 import subprocess
+import time
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
 import numpy as np
@@ -14,54 +24,427 @@ from sklearn.model_selection import train_test_split
 
 from smexperiments.tracker import Tracker
 
-import dvc.api
-
+from git.exc import GitCommandError
 from git.repo.base import Repo
 
 # Prepare paths
 input_data_path = os.path.join("/opt/ml/processing/input", "dataset.csv")
 data_path = 'dataset'
-base_dir = f"./sagemaker-dvc-sample/{data_path}"
+repo_dir = './sagemaker-dvc-sample'
+base_dir = f"{repo_dir}/{data_path}"
 file_types = ['test','train','validation']
+output_formats = ['csv', 'parquet', 'npy']
+NPY_HEADER_SIZE = 128
+# records the fingerprint of the input and split parameters on the branch
+fingerprint_file = 'preprocessing.json'
+# wall time, CPU time, peak RSS and bytes of every phase of the job
+phase_report_path = '/opt/ml/processing/output/phases.json'
+
+dvc_md5_pattern = re.compile(r'^\s*-?\s*md5:\s*([0-9a-f]{32}(?:\.dir)?)\s*$', re.MULTILINE)
 
 dvc_repo_url = os.environ.get('DVC_REPO_URL')
 dvc_branch = os.environ.get('DVC_BRANCH')
 user = os.environ.get('USER', "sagemaker")
+# one of the strategies of dvc_fetch.py of the training jobs
+clone_strategies = ['shallow', 'blobless', 'sparse']
+clone_strategy = os.environ.get('DVC_CLONE_STRATEGY', 'shallow')
+
+# A verbatim copy of the functions and PhaseRecorder of phase_metrics.py: the processing job runs
+# this single file (the code of a ScriptProcessor), without the modules next to it.
+def reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) of the process to its current RSS when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Return the peak RSS of this process in bytes, since the last reset_peak_rss on Linux."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_peak_rss():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def cpu_seconds():
+    # user and system time of this process and of the subprocesses it waited for (git, dvc)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class PhaseRecorder(object):
+    """Records the phases of a job, which may be nested (e.g. clone and dvc pull within a fetch)."""
+
+    def __init__(self):
+        self.phases = []
+        self._open = []
+
+    @contextmanager
+    def phase(self, name):
+        """Record the block as the phase name, yielding its record, where the block can set 'bytes'."""
+        record = {'phase': name}
+        if self._open:
+            # keep the peak of the enclosing phase so far, before resetting it
+            self.record_nested_peak(peak_rss())
+        self._open.append(record)
+        reset_peak_rss()
+        children_peak = children_peak_rss()
+        start, start_cpu = time.time(), cpu_seconds()
+        try:
+            yield record
+        except BaseException:
+            record['failed'] = True
+            raise
+        finally:
+            record['wall_seconds'] = time.time() - start
+            record['cpu_seconds'] = cpu_seconds() - start_cpu
+            # the peak was reset by every nested phase, which recorded it before, and the peak of
+            # the subprocesses only counts when one of this phase set a new maximum
+            peak = max(peak_rss(), record.pop('_nested_peak', 0))
+            if children_peak_rss() > children_peak:
+                peak = max(peak, children_peak_rss())
+            record['peak_rss_mb'] = peak / 1e6
+            self._open.pop()
+            if self._open:
+                self.record_nested_peak(peak)
+            self.phases.append(record)
+            print(self.describe(record))
+
+    def record_nested_peak(self, peak):
+        parent = self._open[-1]
+        parent['_nested_peak'] = max(parent.get('_nested_peak', 0), peak)
+
+    @staticmethod
+    def describe(record):
+        line = 'phase {phase}: wall_seconds={wall_seconds:.3f} cpu_seconds={cpu_seconds:.3f} ' \
+               'peak_rss_mb={peak_rss_mb:.1f}'.format(**record)
+        if record.get('bytes') is not None:
+            line += ' bytes={}'.format(record['bytes'])
+        if record.get('failed'):
+            line += ' failed'
+        return line
+
+    def save(self, path):
+        """Write the phases recorded so far as a JSON report."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'phases': self.phases}, f, indent=2)
+        print('Phase report saved to {}'.format(path))
+
+    def log_to_tracker(self):
+        """Log the phases as parameters of the trial component of the job, e.g. fit_wall_seconds."""
+        try:
+            from smexperiments.tracker import Tracker
+        except ImportError:
+            print('sagemaker-experiments is not installed, phases not logged to the trial component')
+            return
+        parameters = {}
+        for record in self.phases:
+            for key, value in record.items():
+                if key != 'phase':
+                    parameters['{}_{}'.format(record['phase'], key)] = value
+        with Tracker.load() as tracker:
+            tracker.log_parameters(parameters)
+
+phases = PhaseRecorder()
+
+def directory_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file() and not f.is_symlink())
 
 def configure_git():
     subprocess.check_call(['git', 'config', '--global', 'user.email', '"sagemaker-processing@example.com"'])
     subprocess.check_call(['git', 'config', '--global', 'user.name', user])
     
 def split_dataframe(df, num=5):
-    chunk_size = int(df.shape[0] / num)
-    chunks = [df.iloc[i:i+chunk_size] for i in range(0,df.shape[0], chunk_size)]
+    """Split df into exactly num contiguous chunks whose sizes differ by at most one row."""
+    num = max(1, min(num, df.shape[0]))
+    bounds = np.linspace(0, df.shape[0], num + 1).astype(int)
+    chunks = [df.iloc[bounds[i]:bounds[i + 1]] for i in range(num)]
     return chunks
 
+def estimated_row_bytes(sample, output_format):
+    """Estimate the size of one row in the given output format from a sample of rows."""
+    if output_format == 'npy':
+        return 4 * sample.shape[1]
+    if output_format == 'parquet':
+        return 8 * sample.shape[1]
+    return max(1.0, len(sample.to_csv(header=False, index=False)) / max(1, sample.shape[0]))
+
+def shard_count(rows, default_count, row_bytes, shard_rows=None, shard_bytes=None):
+    """Number of shards for a split: sized by rows or bytes when requested, else the default count."""
+    if shard_rows:
+        return max(1, math.ceil(rows / shard_rows))
+    if shard_bytes:
+        return max(1, math.ceil(rows * row_bytes / shard_bytes))
+    return default_count
+
+def write_shard(path, output_format, columns, chunk):
+    with ShardWriter(path, output_format, columns) as writer:
+        writer.write(chunk)
+    return writer.path
+
 def clone_dvc_git_repo():
-    print(f"Cloning repo: {dvc_repo_url}")
-    repo = Repo.clone_from(dvc_repo_url, './sagemaker-dvc-sample')
+    """Clone the DVC Git repository, or update the working copy left by a previous run.
+
+    Like the training jobs, DVC_CLONE_STRATEGY selects a shallow clone (default), a blobless
+    partial clone that fetches file contents on demand, or a blobless clone with a sparse
+    checkout of the dataset. Every strategy fetches the tip of each branch only: the fingerprint
+    of the DVC branch is read from its tip and the new commit is pushed on top of it."""
+    if clone_strategy not in clone_strategies:
+        raise ValueError(f"Unknown clone strategy {clone_strategy}, expected one of {clone_strategies}")
+    if os.path.isdir(f"{repo_dir}/.git"):
+        print(f"Reusing working copy of {dvc_repo_url} in {repo_dir}")
+        repo = Repo(repo_dir)
+        options = ['--depth', '1'] if repo.git.rev_parse('--is-shallow-repository') == 'true' else []
+        repo.git.fetch('origin', '--prune', *options)
+        default_branch = repo.git.rev_parse('--abbrev-ref', 'origin/HEAD')
+        repo.git.checkout('--force', '-B', default_branch.split('/', 1)[1], default_branch)
+        # keep the DVC cache in .dvc/cache, but drop outputs of the previous run
+        repo.git.clean('-ffdx', '--', data_path)
+        if dvc_branch in [head.name for head in repo.heads]:
+            repo.git.branch('-D', dvc_branch)
+        return repo
+
+    print(f"Cloning repo: {dvc_repo_url} ({clone_strategy} clone)")
+    options = ['--depth', '1', '--no-single-branch']
+    if clone_strategy in ('blobless', 'sparse'):
+        options.append('--filter=blob:none')
+    if clone_strategy == 'sparse':
+        options.append('--sparse')
+    repo = Repo.clone_from(dvc_repo_url, repo_dir, multi_options=options)
+    if clone_strategy == 'sparse':
+        repo.git.sparse_checkout('set', data_path, '.dvc')
     return repo
 
-def generate_train_validation_files(ratio):
+    print(f"Cloning repo: {dvc_repo_url} ({clone_strategy} clone)")
+    options = []
+    if clone_strategy in ('blobless', 'sparse'):
+        options.append('--filter=blob:none')
+    if clone_strategy == 'sparse':
+        options.append('--sparse')
+    repo = Repo.clone_from(dvc_repo_url, repo_dir, multi_options=options)
+    if clone_strategy == 'sparse':
+        repo.git.sparse_checkout('set', data_path, '.dvc')
+    return repo
+
+class ShardWriter(object):
+    """Appends DataFrame chunks to a single headerless output shard.
+
+    csv and parquet shards are written incrementally. npy shards hold a row-major float32
+    matrix whose header is rewritten with the final row count on close, and are described
+    by a <name>.schema.json sidecar so readers can memory-map them without parsing."""
+
+    def __init__(self, path, output_format, columns):
+        self.path = f"{path}.{output_format}"
+        self.schema_path = f"{path}.schema.json"
+        self.output_format = output_format
+        self.columns = [str(column) for column in columns]
+        self.rows = 0
+        self._parquet_writer = None
+        self._file = None
+        if output_format == 'csv':
+            self._file = open(self.path, 'w', newline='')
+        elif output_format == 'npy':
+            self._file = open(self.path, 'wb')
+            self._write_npy_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_npy_header(self):
+        # .npy v1.0 header padded to a fixed size, so it can be rewritten in place
+        header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (self.rows, len(self.columns))
+        header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+        self._file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+    def write(self, chunk):
+        if self.output_format == 'csv':
+            chunk.to_csv(self._file, header=False, index=False)
+        elif self.output_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk.astype(np.float64), preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            self._file.write(np.ascontiguousarray(chunk.values, dtype=np.float32).tobytes())
+        self.rows += chunk.shape[0]
+
+    def close(self):
+        if self.output_format == 'parquet':
+            if self._parquet_writer is None:
+                self.write(pd.DataFrame(columns=self.columns))
+            self._parquet_writer.close()
+        elif self.output_format == 'npy':
+            self._file.seek(0)
+            self._write_npy_header()
+            self._file.close()
+            with open(self.schema_path, 'w') as schema:
+                json.dump({
+                    "columns": self.columns,
+                    "label_column": self.columns[0],
+                    "dtype": "float32",
+                    "rows": self.rows,
+                }, schema)
+        else:
+            self._file.close()
+
+def generate_train_validation_files(ratio, output_format, shard_rows=None, shard_bytes=None, shard_writers=None):
     for path in ['train', 'validation', 'test']:
         output_dir = Path(f"{base_dir}/{path}/")
         output_dir.mkdir(parents=True, exist_ok=True)
 
     print("Read dataset")
-    dataset = pd.read_csv(input_data_path)
+    with phases.phase('read_dataset') as phase:
+        dataset = pd.read_csv(input_data_path)
+        phase['bytes'] = os.path.getsize(input_data_path)
     train, other = train_test_split(dataset, test_size=ratio)
     validation, test = train_test_split(other, test_size=ratio)
     
     print("create train, validation, test")
-    for index, chunk in enumerate(split_dataframe(pd.DataFrame(train))):
-        chunk.to_csv(f"{base_dir}/train/california_train_{index + 1}.csv", header=False, index=False)
+    row_bytes = estimated_row_bytes(dataset.head(1000), output_format)
+    train_shards = shard_count(train.shape[0], 5, row_bytes, shard_rows, shard_bytes)
+    validation_shards = shard_count(validation.shape[0], 3, row_bytes, shard_rows, shard_bytes)
+    print(f"Write {train_shards} train and {validation_shards} validation shards")
 
-    for index, chunk in enumerate(split_dataframe(pd.DataFrame(validation), 3)):
-        chunk.to_csv(f"{base_dir}/validation/california_validation_{index + 1}.csv", header=False, index=False)
-    
-    pd.DataFrame(test).to_csv(f"{base_dir}/test/california_test.csv", header=False, index=False)
+    shards = [(f"{base_dir}/test/california_test", pd.DataFrame(test))]
+    for index, chunk in enumerate(split_dataframe(pd.DataFrame(train), train_shards)):
+        shards.append((f"{base_dir}/train/california_train_{index + 1}", chunk))
+    for index, chunk in enumerate(split_dataframe(pd.DataFrame(validation), validation_shards)):
+        shards.append((f"{base_dir}/validation/california_validation_{index + 1}", chunk))
+
+    # serializing is CPU bound, so shards are written by a pool of processes
+    with ProcessPoolExecutor(max_workers=shard_writers) as pool:
+        futures = [pool.submit(write_shard, path, output_format, dataset.columns, chunk) for path, chunk in shards]
+        for future in futures:
+            print(f"wrote {future.result()}")
+    print("data created")
+
+def split_assignments(chunk, ratio, seed):
+    """Assign each row of chunk to train (0), validation (1) or test (2) and to a shard.
+
+    The assignment only depends on the row content and the seed, so it is reproducible
+    across runs and independent of how the input is chunked. The proportions match the
+    in-memory split: 1 - ratio for train, ratio * (1 - ratio) for validation and
+    ratio * ratio for test. The returned hashes are used to pick the output shard."""
+    hash_key = str(seed).rjust(16, '0')[-16:]
+    # pandas infers the dtype of each chunk, e.g. int64 for a column of whole numbers but float64 in a
+    # chunk where it misses a value, and the same value hashes differently in each
+    hashes = pd.util.hash_pandas_object(chunk.astype(np.float64), index=False, hash_key=hash_key).values
+    uniform = (hashes >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+    return np.digitize(uniform, [1 - ratio, 1 - ratio * ratio]), hashes
+
+def generate_train_validation_files_streaming(ratio, chunk_size, seed, output_format, shard_rows=None, shard_bytes=None):
+    split_names = ['train', 'validation', 'test']
+    for path in split_names:
+        output_dir = Path(f"{base_dir}/{path}/")
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"Stream dataset in chunks of {chunk_size} rows")
+    # the row count is not known upfront, so shard counts are sized from a sample of the input
+    sample = pd.read_csv(input_data_path, nrows=1000)
+    input_rows = os.path.getsize(input_data_path) / estimated_row_bytes(sample, 'csv')
+    row_bytes = estimated_row_bytes(sample, output_format)
+    train_shards = shard_count(input_rows * (1 - ratio), 5, row_bytes, shard_rows, shard_bytes)
+    validation_shards = shard_count(input_rows * ratio * (1 - ratio), 3, row_bytes, shard_rows, shard_bytes)
+    print(f"Write {train_shards} train and {validation_shards} validation shards")
+    shard_files = {
+        'train': [f"california_train_{index + 1}" for index in range(train_shards)],
+        'validation': [f"california_validation_{index + 1}" for index in range(validation_shards)],
+        'test': ["california_test"],
+    }
+    columns = sample.columns
+    rows = [0, 0, 0]
+    with ExitStack() as stack:
+        outputs = [
+            [
+                stack.enter_context(ShardWriter(f"{base_dir}/{path}/{name}", output_format, columns))
+                for name in shard_files[path]
+            ]
+            for path in split_names
+        ]
+        for chunk in pd.read_csv(input_data_path, chunksize=chunk_size):
+            assignments, hashes = split_assignments(chunk, ratio, seed)
+            for split, shards in enumerate(outputs):
+                in_split = assignments == split
+                rows[split] += int(in_split.sum())
+                shard_index = hashes % np.uint64(len(shards))
+                for index, output in enumerate(shards):
+                    output.write(chunk[in_split & (shard_index == index)])
+    for path, count in zip(split_names, rows):
+        print(f"{path}: {count} rows")
     print("data created")
 
+def input_fingerprint(parameters):
+    """Hash the input dataset together with the parameters that determine the outputs."""
+    digest = hashlib.sha256()
+    with open(input_data_path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(block)
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def recorded_fingerprint(repo):
+    """Return the fingerprint and commit hash recorded on the remote branch, or (None, None)."""
+    ref = f"origin/{dvc_branch}"
+    try:
+        recorded = json.loads(repo.git.show(f"{ref}:{data_path}/{fingerprint_file}"))
+        return recorded.get('fingerprint'), repo.git.rev_parse(ref)
+    except (GitCommandError, ValueError):
+        return None, None
+
+def write_fingerprint(fingerprint, parameters):
+    with open(f"{base_dir}/{fingerprint_file}", 'w') as f:
+        json.dump({"fingerprint": fingerprint, "parameters": parameters}, f, indent=2, sort_keys=True)
+
+def dvc_remote_url(repo_root):
+    """Return the URL of the default DVC remote from the local repository config.
+
+    Like DVC, a local remote given as a relative path is resolved against the directory of the
+    config file that defines it."""
+    remote, urls = None, {}
+    for config_path in [f"{repo_root}/.dvc/config", f"{repo_root}/.dvc/config.local"]:
+        config = configparser.RawConfigParser()
+        config.read(config_path)
+        for section in config.sections():
+            # DVC writes remote sections as ['remote "name"']
+            name = section.strip("'").replace('"', '')
+            if name == 'core' and config.has_option(section, 'remote'):
+                remote = config.get(section, 'remote')
+            elif name.startswith('remote ') and config.has_option(section, 'url'):
+                url = config.get(section, 'url')
+                if '://' not in url:
+                    url = os.path.normpath(os.path.join(os.path.dirname(config_path), url))
+                urls[name[len('remote '):]] = url
+    return urls[remote].rstrip('/')
+
+def dvc_output_urls(repo_root, dvc_files):
+    """Resolve the remote URL of every output from the md5s in the local .dvc files.
+
+    This is the URL dvc.api.get_url returns, computed in one pass over the checkout we
+    just committed instead of resolving the Git repository again for each output."""
+    remote_url = dvc_remote_url(repo_root)
+    urls = []
+    for dvc_file in dvc_files:
+        with open(dvc_file) as f:
+            md5 = dvc_md5_pattern.search(f.read()).group(1)
+        urls.append(f"{remote_url}/{md5[:2]}/{md5[2:]}")
+    return urls
+
 def sync_data_with_dvc(repo):
     os.chdir(base_dir)
     print(f"Create branch {dvc_branch}")
@@ -73,45 +456,110 @@ def sync_data_with_dvc(repo):
         print(f"Checkout existing branch: {dvc_branch}")
     print("Add files to DVC")
     
-    for file_type in file_types:
-        subprocess.check_call(['dvc', 'add', f"{file_type}/"])
+    with phases.phase('dvc_add') as phase:
+        phase['bytes'] = sum(directory_size(file_type) for file_type in file_types)
+        subprocess.check_call(['dvc', 'add'] + [f"{file_type}/" for file_type in file_types])
 
-    repo.git.add(all=True)
-    repo.git.commit('-m', f"'add data for {dvc_branch}'")
+    with phases.phase('git_commit'):
+        repo.git.add(all=True)
+        repo.git.commit('-m', f"'add data for {dvc_branch}'")
     print("Push data to DVC")
-    subprocess.check_call(['dvc', 'push'])
+    with phases.phase('dvc_push'):
+        subprocess.check_call(['dvc', 'push'])
     print("Push dvc metadata to git")
     repo.remote(name='origin')
-    repo.git.push('--set-upstream', repo.remote().name, dvc_branch, '--force')
+    with phases.phase('git_push'):
+        repo.git.push('--set-upstream', repo.remote().name, dvc_branch, '--force')
 
     sha = repo.head.commit.hexsha
     print(f"commit hash: {sha}")
 
+    track_data_commit(repo, sha)
+
+def track_data_commit(repo, sha):
+    dvc_files = [f"{repo.working_tree_dir}/{data_path}/{file_type}.dvc" for file_type in file_types]
+    urls = dvc_output_urls(repo.working_tree_dir, dvc_files)
     with Tracker.load() as tracker:
         tracker.log_parameters({"data_commit_hash": sha})
-        for file_type in file_types:
-            path = dvc.api.get_url(
-                f"{data_path}/{file_type}",
-                repo=dvc_repo_url,
-                rev=dvc_branch
-            )
+        for file_type, path in zip(file_types, urls):
             tracker.log_output(name=f"{file_type}",value=path)
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--train-test-split-ratio", type=float, default=0.3)
+    # streaming mode reads the input in chunks and splits rows by a seeded row hash,
+    # so memory stays bounded by the chunk size instead of the dataset size
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--split-seed", type=int, default=42)
+    # parquet and npy outputs avoid re-parsing text in every consumer; npy shards are
+    # float32 matrices that the training scripts memory-map
+    parser.add_argument("--output-format", choices=output_formats, default='csv')
+    # re-run the split and push even if the input and parameters match the branch
+    parser.add_argument("--force", action="store_true")
+    # JSON report of the phases, add a ProcessingOutput of its directory to upload it
+    parser.add_argument("--phase-report", type=str, default=phase_report_path)
+    # also log the phase metrics as parameters of the trial component of the job
+    parser.add_argument("--track-phases", action="store_true")
+    # size shards by rows or by megabytes instead of the default 5 train and 3 validation shards
+    parser.add_argument("--shard-rows", type=int, default=None)
+    parser.add_argument("--shard-size-mb", type=float, default=None)
+    # number of processes writing shards, defaults to the number of CPUs
+    parser.add_argument("--shard-writers", type=int, default=None)
     args, _ = parser.parse_known_args()
     
     train_test_split_ratio = args.train_test_split_ratio
+    shard_bytes = int(args.shard_size_mb * 1024 * 1024) if args.shard_size_mb else None
     
     with Tracker.load() as tracker:
         tracker.log_parameters(
             {
-                "train_test_split_ratio": train_test_split_ratio
+                "train_test_split_ratio": train_test_split_ratio,
+                "streaming": args.streaming,
+                "split_seed": args.split_seed,
+                "output_format": args.output_format,
             }
         )
     
     configure_git()
-    repo = clone_dvc_git_repo()
-    generate_train_validation_files(train_test_split_ratio)
-    sync_data_with_dvc(repo)
+    with phases.phase('clone') as phase:
+        repo = clone_dvc_git_repo()
+        phase['bytes'] = directory_size(repo_dir)
+
+    # the chunk size does not change the outputs, so it is not part of the fingerprint
+    split_parameters = {
+        "layout": "multifiles",
+        "train_test_split_ratio": train_test_split_ratio,
+        "streaming": args.streaming,
+        "split_seed": args.split_seed,
+        "output_format": args.output_format,
+        "shard_rows": args.shard_rows,
+        "shard_size_mb": args.shard_size_mb,
+    }
+    if args.streaming:
+        # rows were hashed with their inferred dtypes before, which made the split depend on the chunks
+        split_parameters["row_hash"] = "float64"
+    fingerprint = input_fingerprint(split_parameters)
+    recorded, recorded_sha = recorded_fingerprint(repo)
+    if fingerprint == recorded and not args.force:
+        print(f"Input and split parameters unchanged since commit {recorded_sha}, skipping split and push")
+        repo.git.checkout(dvc_branch)
+        track_data_commit(repo, recorded_sha)
+    else:
+        with phases.phase('split') as phase:
+            if args.streaming:
+                generate_train_validation_files_streaming(
+                    train_test_split_ratio, args.chunk_size, args.split_seed, args.output_format,
+                    args.shard_rows, shard_bytes
+                )
+            else:
+                generate_train_validation_files(
+                    train_test_split_ratio, args.output_format, args.shard_rows, shard_bytes, args.shard_writers
+                )
+            phase['bytes'] = sum(directory_size(f"{base_dir}/{file_type}") for file_type in file_types)
+        write_fingerprint(fingerprint, split_parameters)
+        sync_data_with_dvc(repo)
+
+    phases.save(args.phase_report)
+    if args.track_phases:
+        phases.log_to_tracker()
@@ -11,11 +11,17 @@ import argparse
 import joblib
 
 from sklearn.ensemble import RandomForestRegressor
-from catboost import CatBoostRegressor
+from catboost import CatBoostRegressor, Pool
 
 import numpy as np
 import pandas as pd
 
+from dataset_cache import DatasetCache, load_channel_cached, load_train_pool_cached
+from checkpoints import checkpoint_dir, fit_with_snapshot
+from dvc_fetch import clone_repo, directory_size, pull_channels
+from hyperparameter_sweep import configurations, parse_search_space, run_sweep, write_results
+from phase_metrics import PhaseRecorder
+
 prefix = '/opt/ml/'
 input_path = prefix + 'input/data'
 dataset_path = prefix + 'input/data/dataset'
@@ -25,6 +31,10 @@ validation_channel_name = 'validation'
 output_path = os.path.join(prefix, 'output')
 model_path = os.path.join(prefix, 'model')
 model_file_name = 'catboost-regressor-model.dump'
+# per-configuration metrics of a sweep, uploaded with the rest of output/data
+sweep_results_path = os.path.join(output_path, 'data', 'sweep_results.csv')
+# wall time, CPU time, peak RSS and bytes of every phase of the job
+phase_report_path = os.path.join(output_path, 'data', 'phases.json')
 #model_file_name = 'model.joblib'
 train_path = os.path.join(dataset_path, train_channel_name)
 validation_path = os.path.join(dataset_path, validation_channel_name)
@@ -32,13 +42,28 @@ validation_path = os.path.join(dataset_path, validation_channel_name)
 dvc_repo_url = os.environ.get('DVC_REPO_URL')
 dvc_branch = os.environ.get('DVC_BRANCH')
 user = os.environ.get('USER', "sagemaker")
-
-def fetch_data_from_dvc():
-    print(f"Cloning repo: {dvc_repo_url}, git branch: {dvc_branch}")
-    subprocess.check_call(["git", "clone", "--depth", "1", "--branch", dvc_branch, dvc_repo_url, input_path])
-    print("dvc pull")
-    os.chdir(input_path + "/dataset/")
-    subprocess.check_call(["dvc", "pull"])
+# parallel jobs for dvc pull and an optional DVC cache directory shared across jobs
+dvc_jobs = os.environ.get('DVC_JOBS')
+dvc_cache_dir = os.environ.get('DVC_CACHE_DIR')
+# one of shallow, blobless or sparse
+clone_strategy = os.environ.get('DVC_CLONE_STRATEGY', 'shallow')
+
+phases = PhaseRecorder()
+
+def fetch_data_from_dvc(cache=None):
+    with phases.phase('fetch_data_from_dvc'):
+        print(f"Cloning repo: {dvc_repo_url}, git branch: {dvc_branch}")
+        with phases.phase('clone') as phase:
+            clone_repo(dvc_repo_url, dvc_branch, input_path, clone_strategy)
+            phase['bytes'] = directory_size(input_path)
+        os.chdir(input_path + "/dataset/")
+        if cache is not None and cache.has_training_data(dataset_path, train_channel_name, validation_channel_name):
+            print("dataset cache holds the data for this commit, skipping dvc pull")
+            return
+        print("dvc pull")
+        with phases.phase('dvc_pull') as phase:
+            phase['bytes'] = pull_channels(dataset_path, [train_channel_name, validation_channel_name],
+                                           jobs=dvc_jobs, cache_dir=dvc_cache_dir)
 
 # Model serving
 """
@@ -57,70 +82,81 @@ if __name__ == '__main__':
     # to simplify the demo we don't use all sklearn RandomForest hyperparameters
     parser.add_argument("--learning_rate", type=int, default=1)
     parser.add_argument("--depth", type=int, default=5)
+    # number of threads used to read the shards of a channel, defaults to the executor default
+    parser.add_argument("--loader-workers", type=int, default=None)
+    # a JSON search space (or the path of one) trains every configuration on the same data and keeps the best,
+    # e.g. '{"learning_rate": [0.03, 0.1], "depth": [4, 6, 8]}'; with --sweep-samples, random search instead of grid
+    parser.add_argument("--sweep-space", type=str, default=None)
+    parser.add_argument("--sweep-samples", type=int, default=None)
+    # configurations trained at a time, defaults to the number of CPUs
+    parser.add_argument("--sweep-parallelism", type=int, default=None)
+    # stop when the validation RMSE has not improved for this many iterations, keeping the best model
+    parser.add_argument("--early-stopping-rounds", type=int, default=None)
+    # CatBoost snapshots are saved there (when the directory exists) and resumed after a restart
+    parser.add_argument("--checkpoint-dir", type=str, default=checkpoint_dir)
+    parser.add_argument("--snapshot-interval", type=int, default=600, help="seconds between snapshots")
+    # also log the phase metrics as parameters of the trial component of the job
+    parser.add_argument("--track-phases", action="store_true")
     
     args, _ = parser.parse_known_args()
 
-    fetch_data_from_dvc()
+    # DATASET_CACHE_DIR enables the local cache of parsed channels keyed by their DVC md5s
+    cache = DatasetCache.from_environment()
+    fetch_data_from_dvc(cache)
     
     print('Starting the training.')
 
     try:
-        # Take the set of train files and read them all into a single pandas dataframe
-        train_input_files = [os.path.join(train_path, file) for file in glob.glob(train_path+"/*.csv")]
-        if len(train_input_files) == 0:
-            raise ValueError(('There are no files in {}.\n' +
-                              'This usually indicates that the channel ({}) was incorrectly specified,\n' +
-                              'the data specification in S3 was incorrectly specified or the role specified\n' +
-                              'does not have permission to access the data.').format(train_path, train_channel_name))
-        print('Found train files: {}'.format(train_input_files))
-        train_df = pd.DataFrame()
-        for file in train_input_files:
-            if train_df.shape[0] == 0:
-                train_df = pd.read_csv(file)
-            else:
-                df = pd.read_csv(file)
-                train_df.append(df, ignore_index=True)
-
-        # Take the set of train files and read them all into a single pandas dataframe
-        validation_input_files = [os.path.join(validation_path, file) for file in glob.glob(validation_path+"/*.csv")]
-        if len(validation_input_files) == 0:
-            raise ValueError(('There are no files in {}.\n' +
-                              'This usually indicates that the channel ({}) was incorrectly specified,\n' +
-                              'the data specification in S3 was incorrectly specified or the role specified\n' +
-                              'does not have permission to access the data.').format(validation_path, train_channel_name))
-        print('Found validation files: {}'.format(validation_input_files))
-        validation_df = pd.DataFrame()
-        for file in validation_input_files:
-            if validation_df.shape[0] == 0:
-                validation_df = pd.read_csv(file)
-            else:
-                df = pd.read_csv(file)
-                validation_df.append(df, ignore_index=True)
-
-        # Assumption is that the label is the last column
+        # Read every shard of the train and validation channels; the label is the first column
         print('building training and validation datasets')
-        X_train = train_df.iloc[:, 1:].values
-        y_train = train_df.iloc[:, 0:1].values
-        X_validation = validation_df.iloc[:, 1:].values
-        y_validation = validation_df.iloc[:, 0:1].values
-
-        # define and train model
-        model = CatBoostRegressor(learning_rate=args.learning_rate, depth=args.depth)
-
-        model.fit(X_train, y_train, eval_set=(X_validation, y_validation), logging_level='Silent')
+        with phases.phase('load_train') as phase:
+            if cache is not None and cache.quantized_pool:
+                train_pool = load_train_pool_cached(cache, dataset_path, train_channel_name, max_workers=args.loader_workers)
+            else:
+                X_train, y_train = load_channel_cached(cache, dataset_path, train_channel_name, max_workers=args.loader_workers)
+                phase['bytes'] = X_train.nbytes + y_train.nbytes
+                train_pool = Pool(X_train, y_train)
+        with phases.phase('load_validation') as phase:
+            X_validation, y_validation = load_channel_cached(
+                cache, dataset_path, validation_channel_name, max_workers=args.loader_workers
+            )
+            phase['bytes'] = X_validation.nbytes + y_validation.nbytes
+
+        if args.sweep_space:
+            with phases.phase('sweep'):
+                configs = configurations(parse_search_space(args.sweep_space), args.sweep_samples)
+                results, model = run_sweep(train_pool, X_validation, y_validation, configs, args.sweep_parallelism,
+                                           early_stopping_rounds=args.early_stopping_rounds,
+                                           snapshot_dir=args.checkpoint_dir, snapshot_interval=args.snapshot_interval)
+                write_results(results, sweep_results_path)
+        else:
+            # define and train model
+            model = CatBoostRegressor(learning_rate=args.learning_rate, depth=args.depth)
+
+            with phases.phase('fit'):
+                fit_with_snapshot(model, train_pool, (X_validation, y_validation),
+                                  args.checkpoint_dir, args.snapshot_interval,
+                                  early_stopping_rounds=args.early_stopping_rounds, logging_level='Silent')
+            print('best iteration: {} of {}'.format(model.get_best_iteration(), model.tree_count_))
 
         # print abs error
         print('validating model')
-        abs_err = np.abs(model.predict(X_validation) - y_validation)
+        with phases.phase('evaluate'):
+            abs_err = np.abs(model.predict(X_validation) - y_validation)
 
-        # print couple perf metrics
-        for q in [10, 50, 90]:
-            print('AE-at-' + str(q) + 'th-percentile: '+ str(np.percentile(a=abs_err, q=q)))
+            # print couple perf metrics
+            for q in [10, 50, 90]:
+                print('AE-at-' + str(q) + 'th-percentile: '+ str(np.percentile(a=abs_err, q=q)))
 
         path = os.path.join(model_path, model_file_name)
-        model.save_model(path)
+        with phases.phase('save_model') as phase:
+            model.save_model(path)
+            phase['bytes'] = os.path.getsize(path)
 
         print('Training complete.')
+        phases.save(phase_report_path)
+        if args.track_phases:
+            phases.log_to_tracker()
         
     except Exception as e:
         # Write out an error file. This will be returned as the failureReason in the
@@ -130,6 +166,7 @@ if __name__ == '__main__':
             s.write('Exception during training: ' + str(e) + '\n' + trc)
         # Printing this causes the exception to be in the training job logs, as well.
         print('Exception during training: ' + str(e) + '\n' + trc)
+        phases.save(phase_report_path)
         # A non-zero exit dependencies causes the training job to be marked as Failed.
         sys.exit(255)
 
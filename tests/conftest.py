@@ -0,0 +1,10 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the shared modules of the jobs live in source_dir (and are copied into the container), next to
+# the container's own modules such as predictor.py
+sys.path.insert(0, os.path.join(root, 'container', 'train_and_serve', 'catboost_regressor'))
+sys.path.insert(0, os.path.join(root, 'source_dir'))
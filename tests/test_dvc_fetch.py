@@ -0,0 +1,131 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# dvc_fetch.py against a local bare Git repository and a local DVC remote in tmp_path.
+import os
+import subprocess
+
+import pytest
+
+from dvc_fetch import clone_repo, pull_channels
+
+channels = ['train', 'validation', 'test']
+
+
+def run(command, cwd):
+    subprocess.check_call(command, cwd=str(cwd), stdout=subprocess.DEVNULL)
+
+
+def output(command, cwd):
+    return subprocess.check_output(command, cwd=str(cwd)).decode().strip()
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for role in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_{}_NAME'.format(role), 'sagemaker')
+        monkeypatch.setenv('GIT_{}_EMAIL'.format(role), 'sagemaker@example.com')
+    monkeypatch.setenv('DVC_NO_ANALYTICS', '1')
+
+
+@pytest.fixture
+def dvc_repo(tmp_path):
+    """Return the file:// URL of a bare repository whose main branch tracks the train, validation
+    and test channels of its dataset directory with DVC, pushed to a local remote."""
+    origin, work = tmp_path / 'origin.git', tmp_path / 'work'
+    run(['git', 'init', '--bare', str(origin)], tmp_path)
+    # blobless and sparse clones need a server that accepts filters
+    run(['git', 'config', 'uploadpack.allowFilter', 'true'], origin)
+    work.mkdir()
+    run(['git', 'init'], work)
+    run(['dvc', 'init'], work)
+    run(['dvc', 'remote', 'add', '-d', 'storage', str(tmp_path / 'remote')], work)
+    run(['git', 'add', '.'], work)
+    run(['git', 'commit', '-m', 'Initialize DVC'], work)
+    for channel in channels:
+        os.makedirs(str(work / 'dataset' / channel))
+        (work / 'dataset' / channel / '{}-0.csv'.format(channel)).write_text('1.0,2.0,3.0\n')
+    (work / 'notebooks').mkdir()
+    (work / 'notebooks' / 'analysis.txt').write_text('not part of the dataset\n')
+    run(['dvc', 'add'] + channels, work / 'dataset')
+    run(['dvc', 'push'], work)
+    run(['git', 'add', '.'], work)
+    run(['git', 'commit', '-m', 'Add the dataset'], work)
+    run(['git', 'push', origin.as_uri(), 'HEAD:refs/heads/main'], work)
+    return origin.as_uri()
+
+
+def test_pull_channels_fetches_only_the_given_channels(dvc_repo, tmp_path):
+    path = tmp_path / 'clone'
+    clone_repo(dvc_repo, 'main', str(path))
+    # the cache of a fresh clone is empty: dvc checkout fails and dvc pull downloads the channels
+    transferred = pull_channels(str(path / 'dataset'), ['train', 'validation'], jobs=2)
+    assert transferred > 0
+    assert (path / 'dataset' / 'train' / 'train-0.csv').read_text() == '1.0,2.0,3.0\n'
+    assert (path / 'dataset' / 'validation' / 'validation-0.csv').exists()
+    assert not (path / 'dataset' / 'test').exists()
+
+
+def test_pull_channels_checks_out_from_a_shared_cache(dvc_repo, tmp_path):
+    cache_dir = str(tmp_path / 'shared-cache')
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    clone_repo(dvc_repo, 'main', str(first))
+    assert pull_channels(str(first / 'dataset'), ['train', 'validation'], cache_dir=cache_dir) > 0
+    # the objects are in the shared cache now, so a second job only checks them out
+    clone_repo(dvc_repo, 'main', str(second))
+    assert pull_channels(str(second / 'dataset'), ['train', 'validation'], cache_dir=cache_dir) == 0
+    assert (second / 'dataset' / 'train' / 'train-0.csv').exists()
+    assert (second / 'dataset' / 'validation' / 'validation-0.csv').exists()
+    assert not (second / 'dataset' / 'test').exists()
+
+
+def test_shallow_clone_fetches_a_single_commit(dvc_repo, tmp_path):
+    path = tmp_path / 'clone'
+    clone_repo(dvc_repo, 'main', str(path), 'shallow')
+    assert output(['git', 'rev-list', '--count', 'HEAD'], path) == '1'
+    assert output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], path) == 'main'
+    assert (path / 'notebooks' / 'analysis.txt').exists()
+
+
+def test_blobless_clone_defers_file_contents(dvc_repo, tmp_path):
+    path = tmp_path / 'clone'
+    clone_repo(dvc_repo, 'main', str(path), 'blobless')
+    assert output(['git', 'config', 'remote.origin.partialclonefilter'], path) == 'blob:none'
+    assert output(['git', 'rev-list', '--count', 'HEAD'], path) == '1'
+    assert (path / 'dataset' / 'train.dvc').exists()
+
+
+def test_sparse_clone_checks_out_only_the_dataset(dvc_repo, tmp_path):
+    path = tmp_path / 'clone'
+    clone_repo(dvc_repo, 'main', str(path), 'sparse')
+    assert output(['git', 'config', 'remote.origin.partialclonefilter'], path) == 'blob:none'
+    assert (path / 'dataset' / 'train.dvc').exists()
+    assert (path / '.dvc' / 'config').exists()
+    assert not (path / 'notebooks').exists()
+
+
+def test_unknown_strategy_is_rejected(dvc_repo, tmp_path):
+    with pytest.raises(ValueError):
+        clone_repo(dvc_repo, 'main', str(tmp_path / 'clone'), 'full')
+
+
+@pytest.mark.parametrize('strategy', ['shallow', 'blobless', 'sparse'])
+def test_reused_working_copy_is_updated_and_cleaned(dvc_repo, tmp_path, strategy):
+    path = tmp_path / 'clone'
+    clone_repo(dvc_repo, 'main', str(path), strategy)
+    pull_channels(str(path / 'dataset'), ['train'])
+    (path / 'dataset' / 'leftover.csv').write_text('written by a previous run\n')
+    # a new commit on the branch since the working copy was cloned
+    work = tmp_path / 'work'
+    (work / 'dataset' / 'README.md').write_text('The train, validation and test channels\n')
+    run(['git', 'add', 'dataset/README.md'], work)
+    run(['git', 'commit', '-m', 'Describe the dataset'], work)
+    run(['git', 'push', dvc_repo, 'HEAD:refs/heads/main'], work)
+
+    clone_repo(dvc_repo, 'main', str(path), strategy)
+    assert output(['git', 'rev-parse', 'HEAD'], path) == output(['git', 'rev-parse', 'HEAD'], work)
+    assert (path / 'dataset' / 'README.md').exists()
+    # the outputs of the previous run are gone, the DVC cache is kept
+    assert not (path / 'dataset' / 'leftover.csv').exists()
+    assert not (path / 'dataset' / 'train').exists()
+    assert pull_channels(str(path / 'dataset'), ['train']) == 0
@@ -0,0 +1,40 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The search spaces of hyperparameter_sweep.py.
+import json
+
+import pytest
+
+from hyperparameter_sweep import configurations
+
+
+def distinct(configs):
+    return len(set(json.dumps(config, sort_keys=True) for config in configs))
+
+
+def test_grid_holds_every_configuration_once():
+    configs = configurations({'learning_rate': [0.03, 0.1], 'depth': [4, 4, 6], 'iterations': 100})
+    assert len(configs) == distinct(configs) == 4
+    assert all(config['iterations'] == 100 for config in configs)
+
+
+def test_samples_of_a_grid_are_distinct():
+    space = {'learning_rate': [0.03, 0.1], 'depth': [4, 6], 'l2_leaf_reg': [1, 3]}
+    configs = configurations(space, 8)
+    assert len(configs) == distinct(configs) == 8
+    # a grid smaller than the samples is trained once in full
+    assert distinct(configurations({'learning_rate': [0.03, 0.1], 'depth': [4, 6]}, 8)) == 4
+
+
+def test_samples_of_ranges_are_distinct():
+    configs = configurations({'learning_rate': {'min': 0.01, 'max': 0.3, 'log': True}, 'depth': [4, 6]}, 16)
+    assert len(configs) == distinct(configs) == 16
+    assert all(0.01 <= config['learning_rate'] <= 0.3 for config in configs)
+    # an integer range holds only so many values
+    assert sorted(config['depth'] for config in configurations({'depth': {'min': 4, 'max': 6}}, 8)) == [4, 5, 6]
+
+
+def test_ranges_need_samples():
+    with pytest.raises(ValueError):
+        configurations({'learning_rate': {'min': 0.01, 'max': 0.3}})
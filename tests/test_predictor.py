@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The request decoders of predictor.py.
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import predictor
+
+
+def csv_body(rows, columns=8, seed=0):
+    values = np.random.RandomState(seed).uniform(-1000, 1000, size=(rows, columns)).astype(np.float32)
+    buffer = io.BytesIO()
+    np.savetxt(buffer, values, delimiter=',', fmt='%.7g')
+    return buffer.getvalue()
+
+
+def read_csv(body):
+    return pd.read_csv(io.BytesIO(body), header=None, dtype=np.float32).to_numpy()
+
+
+@pytest.mark.parametrize('rows', [1, 10, 400])
+def test_fast_path_parses_like_pandas(rows):
+    body = csv_body(rows)
+    assert len(body) <= predictor.CSV_FAST_PATH_MAX_BYTES
+    np.testing.assert_array_equal(predictor.parse_numeric_csv(body), read_csv(body))
+
+
+@pytest.mark.parametrize('rows', [1, 10, 400, 5000])
+def test_decode_csv_matches_both_paths(rows, monkeypatch):
+    body = csv_body(rows)
+    decoded = predictor.decode_csv(body)
+    assert decoded.dtype == np.float32
+    # the other path than the one the size selected
+    monkeypatch.setattr(predictor, 'CSV_FAST_PATH_MAX_BYTES', 0 if len(body) <= predictor.CSV_FAST_PATH_MAX_BYTES
+                        else len(body))
+    np.testing.assert_array_equal(predictor.decode_csv(body), decoded)
+
+
+def test_irregular_small_body_goes_through_pandas():
+    body = b'1.5,"2",3\r\n4,,6\n'
+    np.testing.assert_array_equal(predictor.decode_csv(body), np.array([[1.5, 2, 3], [4, np.nan, 6]], np.float32))
@@ -0,0 +1,148 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The preprocessing scripts: clone_dvc_git_repo against a local bare Git repository in tmp_path, and
+# the split of the streaming mode.
+import importlib.util
+import io
+import json
+import os
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+source_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'source_dir')
+scripts = ['preprocessing-experiment', 'preprocessing-experiment-multifiles']
+strategies = ['shallow', 'blobless', 'sparse']
+
+
+def run(command, cwd):
+    subprocess.check_call(command, cwd=str(cwd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def output(command, cwd):
+    return subprocess.check_output(command, cwd=str(cwd)).decode().strip()
+
+
+def commit(work, path, content, message):
+    (work / path).parent.mkdir(parents=True, exist_ok=True)
+    (work / path).write_text(content)
+    run(['git', 'add', path], work)
+    run(['git', 'commit', '-m', message], work)
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for role in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv('GIT_{}_NAME'.format(role), 'sagemaker')
+        monkeypatch.setenv('GIT_{}_EMAIL'.format(role), 'sagemaker@example.com')
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """Return the work tree pushing to a bare repository: two commits on main, the default branch, and
+    a DVC branch with the fingerprint of a previous preprocessing run."""
+    bare, work = tmp_path / 'origin.git', tmp_path / 'work'
+    run(['git', 'init', '--bare', str(bare)], tmp_path)
+    run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/main'], bare)
+    # blobless and sparse clones need a server that accepts filters
+    run(['git', 'config', 'uploadpack.allowFilter', 'true'], bare)
+    work.mkdir()
+    run(['git', 'init'], work)
+    run(['git', 'checkout', '-b', 'main'], work)
+    run(['git', 'remote', 'add', 'origin', bare.as_uri()], work)
+    commit(work, '.dvc/config', '[core]\n    remote = storage\n', 'Initialize DVC')
+    commit(work, 'notebooks/analysis.txt', 'not part of the dataset\n', 'Add a notebook')
+    run(['git', 'checkout', '-b', 'experiment'], work)
+    commit(work, 'dataset/preprocessing.json', json.dumps({'fingerprint': 'first'}), 'add data for experiment')
+    run(['git', 'push', 'origin', 'main', 'experiment'], work)
+    run(['git', 'checkout', 'main'], work)
+    return work
+
+
+def import_script(name):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(source_dir, name + '.py'))
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+
+def load_script(name, origin, tmp_path, strategy, monkeypatch):
+    script = import_script(name)
+    monkeypatch.setattr(script, 'dvc_repo_url', (tmp_path / 'origin.git').as_uri())
+    monkeypatch.setattr(script, 'dvc_branch', 'experiment')
+    monkeypatch.setattr(script, 'repo_dir', str(tmp_path / 'clone'))
+    monkeypatch.setattr(script, 'clone_strategy', strategy)
+    return script
+
+
+@pytest.mark.parametrize('name', scripts)
+@pytest.mark.parametrize('strategy', strategies)
+def test_clone_fetches_the_tip_of_each_branch(origin, tmp_path, monkeypatch, name, strategy):
+    script = load_script(name, origin, tmp_path, strategy, monkeypatch)
+    repo = script.clone_dvc_git_repo()
+    clone = tmp_path / 'clone'
+    assert output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], clone) == 'main'
+    assert output(['git', 'rev-list', '--count', 'HEAD'], clone) == '1'
+    assert script.recorded_fingerprint(repo) == ('first', output(['git', 'rev-parse', 'experiment'], origin))
+    assert (clone / '.dvc' / 'config').exists()
+    assert (clone / 'notebooks').exists() == (strategy != 'sparse')
+    if strategy != 'shallow':
+        assert output(['git', 'config', 'remote.origin.partialclonefilter'], clone) == 'blob:none'
+
+    # the DVC branch is committed and pushed on top of its tip, as sync_data_with_dvc does
+    repo.git.checkout('experiment')
+    commit(clone, 'dataset/preprocessing.json', json.dumps({'fingerprint': 'second'}), 'add data for experiment')
+    repo.git.push('--set-upstream', 'origin', 'experiment', '--force')
+    assert output(['git', 'rev-parse', 'experiment'], tmp_path / 'origin.git') == repo.head.commit.hexsha
+
+
+@pytest.mark.parametrize('name', scripts)
+def test_unknown_strategy_is_rejected(origin, tmp_path, monkeypatch, name):
+    script = load_script(name, origin, tmp_path, 'full', monkeypatch)
+    with pytest.raises(ValueError):
+        script.clone_dvc_git_repo()
+    assert not (tmp_path / 'clone').exists()
+
+
+@pytest.mark.parametrize('name', scripts)
+@pytest.mark.parametrize('strategy', strategies)
+def test_reused_working_copy_is_updated_and_cleaned(origin, tmp_path, monkeypatch, name, strategy):
+    script = load_script(name, origin, tmp_path, strategy, monkeypatch)
+    repo = script.clone_dvc_git_repo()
+    clone = tmp_path / 'clone'
+    # what a previous run left: a local DVC branch and outputs in the dataset directory
+    repo.git.checkout('experiment')
+    (clone / 'dataset' / 'train').mkdir()
+    (clone / 'dataset' / 'train' / 'california_train.csv').write_text('1.0,2.0\n')
+    # and new commits on both branches since
+    commit(origin, 'README.md', 'The DVC repository\n', 'Add a README')
+    run(['git', 'checkout', 'experiment'], origin)
+    commit(origin, 'dataset/preprocessing.json', json.dumps({'fingerprint': 'third'}), 'add data for experiment')
+    run(['git', 'push', 'origin', 'main', 'experiment'], origin)
+
+    repo = script.clone_dvc_git_repo()
+    assert output(['git', 'rev-parse', 'HEAD'], clone) == output(['git', 'rev-parse', 'main'], origin)
+    assert output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], clone) == 'main'
+    assert 'experiment' not in [head.name for head in repo.heads]
+    assert not (clone / 'dataset' / 'train').exists()
+    assert script.recorded_fingerprint(repo) == ('third', output(['git', 'rev-parse', 'experiment'], origin))
+    assert output(['git', 'rev-parse', '--is-shallow-repository'], clone) == 'true'
+
+
+@pytest.mark.parametrize('name', scripts)
+def test_streaming_split_does_not_depend_on_the_chunks(name):
+    script = import_script(name)
+    # a column of whole numbers, read as int64 except in the chunk where it misses a value
+    csv = 'label,rooms\n' + ''.join('{},{}\n'.format(row * 0.5, row % 7) for row in range(1000)) + '0.1,\n'
+
+    def assignments(chunk_size):
+        chunks = pd.read_csv(io.StringIO(csv), chunksize=chunk_size)
+        results = [script.split_assignments(chunk, 0.3, 42) for chunk in chunks]
+        return np.concatenate([result[0] if isinstance(result, tuple) else result for result in results])
+
+    expected = assignments(2000)
+    for chunk_size in (7, 100, 1000):
+        np.testing.assert_array_equal(assignments(chunk_size), expected)